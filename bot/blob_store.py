@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+
+class BlobStore:
+    """
+    Content-addressed store for the images of the conversations.
+    Blobs are kept in memory up to a byte cap, after which the least recently used ones are spilled to disk.
+    Blobs not accessed for `max_age_seconds` are removed by `expire`.
+    The blobs left in the directory by a previous run are removed when the store is created, since
+    conversations do not survive restarts. Only the files of the store, named with the `.blob` extension,
+    are ever removed, so the directory can be shared with other files.
+    """
+
+    def __init__(self, max_memory_bytes: int, directory: str, max_age_seconds: float = 0):
+        """
+        :param max_memory_bytes: The maximum number of bytes to keep in memory, 0 for no limit
+        :param directory: The directory to spill blobs to
+        :param max_age_seconds: The number of seconds after the last access after which a blob expires, 0 to disable
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.memory: OrderedDict[str, tuple[float, bytes]] = OrderedDict()  # {key: (last access, data)}
+        self.memory_bytes = 0
+        for path in self.__blob_paths():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, data: bytes, key: Optional[str] = None) -> str:
+        """
+        Stores a blob.
+        :param data: The blob
+        :param key: A stable identifier of the content, e.g. a Telegram file_unique_id. Defaults to its SHA-256
+        :return: The key of the blob
+        """
+        key = key or hashlib.sha256(data).hexdigest()
+        if key in self.memory:
+            self.memory[key] = (time.monotonic(), self.memory[key][1])
+            self.memory.move_to_end(key)
+            return key
+        self.memory[key] = (time.monotonic(), data)
+        self.memory_bytes += len(data)
+        self.__spill()
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Gets a blob, from memory or from disk.
+        :param key: The key of the blob
+        :return: The blob, or None if it does not exist
+        """
+        if key in self.memory:
+            data = self.memory[key][1]
+            self.memory[key] = (time.monotonic(), data)
+            self.memory.move_to_end(key)
+            return data
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def data_url(self, key: str) -> Optional[str]:
+        """
+        Materialises the data URL of an image blob.
+        :param key: The key of the blob
+        :return: The data URL, or None if the blob does not exist
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        return f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}"
+
+    def expire(self) -> Iterator[bool]:
+        """
+        Removes the blobs that were not accessed for `max_age_seconds`.
+        :return: An iterator yielding True for each removed blob and False for each kept one
+        """
+        if not self.max_age_seconds:
+            return
+        threshold = time.monotonic() - self.max_age_seconds
+        while self.memory:
+            key, (last_access, data) = next(iter(self.memory.items()))
+            if last_access > threshold:
+                break
+            del self.memory[key]
+            self.memory_bytes -= len(data)
+            yield True
+
+        wall_threshold = time.time() - self.max_age_seconds
+        for path in self.__blob_paths():
+            try:
+                if os.path.getmtime(path) < wall_threshold:
+                    os.remove(path)
+                    yield True
+                    continue
+            except OSError:
+                pass
+            yield False
+
+    def __spill(self) -> None:
+        while self.max_memory_bytes and self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            key, (_, data) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(data)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.__path(key), 'wb') as file:
+                    file.write(data)
+            except OSError as e:
+                logging.warning(f'Failed to spill image {key} to disk: {e}')
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.blob')
+
+    def __blob_paths(self) -> list[str]:
+        """
+        Lists the files of the store in its directory, leaving out any other file.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        with os.scandir(self.directory) as entries:
+            return [entry.path for entry in entries if entry.is_file() and entry.name.endswith('.blob')]
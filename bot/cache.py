@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Iterator
+
+
+class TTLCache:
+    """
+    A size-bounded LRU cache whose entries expire after their own time to live.
+    Expired entries are dropped when read, or by `expire`, usually driven by an `ExpirySweeper`.
+    """
+
+    def __init__(self, max_size: int):
+        """
+        :param max_size: The maximum number of entries, 0 to disable the cache
+        """
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()  # {key: (expiry, value)}, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Gets an entry and marks it as the most recently used one.
+        :param key: The key
+        :param default: The value to return if the entry does not exist or has expired
+        :return: The value of the entry
+        """
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: float) -> None:
+        """
+        Sets an entry, evicting the least recently used one if the cache is full.
+        :param key: The key
+        :param value: The value
+        :param ttl_seconds: The number of seconds after which the entry expires
+        """
+        if not self.max_size or ttl_seconds <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def expire(self) -> Iterator[bool]:
+        """
+        Removes the expired entries.
+        :return: An iterator yielding True for each removed entry and False for each kept one
+        """
+        now = time.monotonic()
+        for key, (expiry, _) in list(self._data.items()):
+            if expiry <= now and key in self._data:
+                del self._data[key]
+                yield True
+            else:
+                yield False
+
+    def stats(self) -> dict:
+        """
+        Returns the number of entries and the hit, miss and eviction counters.
+        """
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single in-flight task, whose result or
+    exception is shared by all callers. Callers are reference counted: a cancelled caller stops waiting,
+    but the shared task is only cancelled once every caller waiting for it was cancelled.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, list] = {}  # {key: [task, number of waiting callers]}
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]) -> Any:
+        """
+        Awaits the in-flight call for the key, or starts it.
+        :param key: The key identifying identical calls
+        :param fn: A function returning the awaitable to run if no call is in flight
+        :return: The result of the call
+        """
+        call = self.calls.get(key)
+        if call is None:
+            call = [asyncio.ensure_future(fn()), 0]
+            self.calls[key] = call
+            call[0].add_done_callback(lambda _: self.calls.pop(key) if self.calls.get(key) is call else None)
+        else:
+            self.coalesced += 1
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                # Forget the call right away, so that a caller arriving before it is done starts a new one
+                # instead of joining the cancelled one
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+                call[0].cancel()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import logging
+from operator import attrgetter
+from typing import Optional
+
+import openai
+from http_clients import HttpClients
+from rate_limiter import RateLimiter
+from resilience import CircuitBreaker, RetryPolicy
+from sweeper import ExpiringDict
+
+
+class PoolMember:
+    """
+    An OpenAI client of the pool, i.e. an API key and endpoint with its own limits and health.
+    """
+
+    def __init__(self, name: str, client: openai.AsyncOpenAI, breaker: CircuitBreaker, rate_limiter: RateLimiter):
+        self.name = name
+        self.client = client
+        self.breaker = breaker
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+
+    @property
+    def load(self) -> int:
+        """
+        The number of requests sent to the member and not answered yet, or waiting for its rate limits.
+        """
+        return self.in_flight + self.rate_limiter.queue_depth
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether the member is healthy, i.e. not ejected by its circuit breaker.
+        """
+        return self.breaker.state != 'open'
+
+
+class ClientPool:
+    """
+    Spreads the requests over several OpenAI clients, e.g. several API keys or OpenAI-compatible endpoints,
+    sending each one to the least loaded available member. Members failing repeatedly are ejected
+    by their circuit breaker until a trial request succeeds, and the requests of a chat stick to the member
+    that last answered it while it is available.
+    """
+
+    def __init__(self, members: list[PoolMember], retry_policy: RetryPolicy, affinity_seconds: float):
+        """
+        :param members: The members of the pool
+        :param retry_policy: The retry policy, whose retries go to another member where possible
+        :param affinity_seconds: The number of seconds a chat sticks to its member after its last request
+        """
+        self.members = members
+        self.retry_policy = retry_policy
+        self.affinity = ExpiringDict(affinity_seconds)  # {chat_id: member}
+
+    @classmethod
+    def from_config(cls, config: dict, http_clients: HttpClients) -> ClientPool:
+        """
+        Creates the pool from the `pool` entries of the configuration, each one with an optional `name`,
+        `api_key`, `base_url`, `requests_per_minute` and `tokens_per_minute`, defaulting to the global ones.
+        :param config: The configuration
+        :param http_clients: The shared HTTP clients the members send their requests with
+        """
+        members = []
+        for i, entry in enumerate(config.get('pool') or [{}]):
+            # Retries are left to the retry policy, so that they are not multiplied by the ones of the client
+            client = openai.AsyncOpenAI(
+                api_key=entry.get('api_key', config['api_key']),
+                base_url=entry.get('base_url'),
+                http_client=http_clients.get(config.get('proxy')),
+                max_retries=0,
+            )
+            breaker = CircuitBreaker(
+                failure_threshold=config.get('circuit_breaker_threshold', 5),
+                reset_seconds=config.get('circuit_breaker_reset_seconds', 30),
+            )
+            rate_limiter = RateLimiter(
+                requests_per_minute=entry.get('requests_per_minute', config.get('requests_per_minute', 0)),
+                tokens_per_minute=entry.get('tokens_per_minute', config.get('tokens_per_minute', 0)),
+            )
+            members.append(PoolMember(entry.get('name', f'client {i + 1}'), client, breaker, rate_limiter))
+
+        retry_policy = RetryPolicy(
+            max_attempts=config.get('api_max_attempts', 3),
+            max_delay=config.get('api_max_retry_delay_seconds', 30),
+        )
+        return cls(members, retry_policy, config['max_conversation_age_minutes'] * 60)
+
+    @property
+    def base_urls(self) -> set[str]:
+        """
+        The distinct base URLs of the members.
+        """
+        return {str(member.client.base_url) for member in self.members}
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of requests waiting for the rate limits of their member.
+        """
+        return sum(member.rate_limiter.queue_depth for member in self.members)
+
+    def choose(self, chat_id=None, tried: Optional[set] = None) -> PoolMember:
+        """
+        Chooses the member to send a request to: the one the chat sticks to if it is available,
+        or else the least loaded available one, preferring the ones not tried yet by the request.
+        :param chat_id: The chat ID, None if the request is not part of a chat
+        :param tried: The names of the members the request already failed on
+        :return: The member, possibly ejected if all of them are
+        """
+        tried = tried or set()
+        available = [member for member in self.members if member.available] or self.members
+        candidates = [member for member in available if member.name not in tried] or available
+
+        member = self.affinity.get(chat_id) if chat_id is not None else None
+        if member in candidates:
+            return member
+        return min(candidates, key=lambda member: member.load)
+
+    async def request(self, method: str, tokens: int = 0, chat_id=None, **kwargs):
+        """
+        Sends a request within the rate limits of a member of the pool, retrying its transient failures.
+        :param method: The path of the API method of the client, e.g. `chat.completions.create`
+        :param tokens: The estimated number of tokens of the request, including the completion
+        :param chat_id: The chat ID, None if the request is not part of a chat
+        :return: The response, whose unused reserved tokens are refunded once its usage is known
+        :raises CircuitOpenError: If all members are ejected
+        """
+        tried = set()
+
+        async def attempt():
+            member = self.choose(chat_id, tried)
+            tried.add(member.name)
+            member.breaker.before_call()
+            try:
+                reserved = await member.rate_limiter.acquire(tokens)
+            except BaseException:
+                member.breaker.record_ignored()
+                raise
+            member.in_flight += 1
+            try:
+                response = await attrgetter(method)(member.client)(**kwargs)
+            except BaseException as e:
+                member.in_flight -= 1
+                member.rate_limiter.refund(reserved)
+                if isinstance(e, Exception) and RetryPolicy.is_transient(e):
+                    member.breaker.record_failure()
+                    if len(self.members) > 1:
+                        logging.warning(f'Request to {member.name} failed ({e.__class__.__name__})')
+                else:
+                    member.breaker.record_ignored()
+                raise
+            member.breaker.record_success()
+            if chat_id is not None:
+                self.affinity[chat_id] = member
+
+            if kwargs.get('stream'):
+                return _tracked(response, member, reserved)
+            member.in_flight -= 1
+            if getattr(response, 'usage', None) is not None:
+                member.rate_limiter.refund(reserved, response.usage.total_tokens)
+            return response
+
+        return await self.retry_policy.call(attempt)
+
+
+async def close_stream(stream) -> None:
+    """
+    Closes a streamed response right away, releasing its HTTP connection instead of waiting for it to be
+    garbage collected: `close` for OpenAI streams, `aclose` for the async generators wrapping them.
+    """
+    close = getattr(stream, 'aclose', None) or getattr(stream, 'close', None)
+    if close is not None:
+        await close()
+
+
+async def _tracked(stream, member: PoolMember, reserved: int):
+    """
+    Yields the items of a streamed response, refunding the unused reserved tokens once its usage is streamed,
+    and counting it as in flight until it is consumed.
+    """
+    try:
+        async for item in stream:
+            if getattr(item, 'usage', None) is not None:
+                member.rate_limiter.refund(reserved, item.usage.total_tokens)
+            yield item
+    finally:
+        member.in_flight -= 1
+        await close_stream(stream)
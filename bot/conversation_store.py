@@ -0,0 +1,421 @@
+from __future__ import annotations
+
+import bisect
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import zlib
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Iterator, Optional
+
+from blob_store import BlobStore
+
+
+class Message:
+    """
+    A compact history entry. Images are kept in a `BlobStore` and referenced by key; the text and
+    the image data URL are only assembled into the OpenAI wire format by `to_dict` when a request is built.
+    """
+
+    __slots__ = ('role', 'content', 'name', 'tokens', 'image', 'image_tokens', 'pinned', 'tool_calls', 'tool_call_id')
+
+    def __init__(
+        self,
+        role: str,
+        content: str,
+        name: Optional[str] = None,
+        image: Optional[tuple] = None,
+        image_tokens: int = 0,
+        pinned: bool = False,
+        tool_calls: Optional[list[dict]] = None,
+        tool_call_id: Optional[str] = None,
+    ):
+        """
+        :param role: The role of the message sender
+        :param content: The text of the message
+        :param name: The function name, for function and tool results
+        :param image: The image as a (blob key, detail) tuple, if any
+        :param image_tokens: The number of tokens of the image, computed when it was received
+        :param pinned: Whether the message is kept when the history is truncated, e.g. a summary
+        :param tool_calls: The tool calls requested by the assistant, in the OpenAI wire format
+        :param tool_call_id: The ID of the tool call, for tool results
+        """
+        self.role = sys.intern(role)
+        self.content = content
+        self.name = name
+        self.tokens = 0
+        self.image = image
+        self.image_tokens = image_tokens
+        self.pinned = pinned
+        self.tool_calls = tool_calls
+        self.tool_call_id = tool_call_id
+
+    def wire_content(self, blobs: Optional[BlobStore] = None):
+        """
+        Returns the content in the OpenAI wire format.
+        :param blobs: The store holding the image. Without it, or if the image is gone, only the text is returned
+        """
+        if self.image is None or blobs is None:
+            return self.content
+        key, detail = self.image
+        url = blobs.data_url(key)
+        if url is None:
+            logging.warning(f'Image {key} is no longer available, sending the text only')
+            return self.content
+        return [
+            {'type': 'text', 'text': self.content},
+            {'type': 'image_url', 'image_url': {'url': url, 'detail': detail}},
+        ]
+
+    def to_dict(self, blobs: Optional[BlobStore] = None) -> dict:
+        """
+        Returns the message in the OpenAI wire format.
+        :param blobs: The store holding the image, see `wire_content`
+        """
+        message = {'role': self.role, 'content': self.wire_content(blobs)}
+        if self.tool_calls is not None:
+            message['content'] = self.content or None
+            message['tool_calls'] = self.tool_calls
+        if self.tool_call_id is not None:
+            message['tool_call_id'] = self.tool_call_id
+        elif self.name is not None:
+            message['name'] = self.name
+        return message
+
+    def to_record(self) -> list:
+        """
+        Returns the message as a JSON serializable record, see `from_record`.
+        """
+        return [
+            self.role,
+            self.content,
+            self.name,
+            self.tokens,
+            self.image,
+            self.image_tokens,
+            self.pinned,
+            self.tool_calls,
+            self.tool_call_id,
+        ]
+
+    @classmethod
+    def from_record(cls, record: list) -> Message:
+        """
+        Creates a message from a record returned by `to_record`.
+        """
+        role, content, name, tokens, image, image_tokens, pinned, tool_calls, tool_call_id = record
+        image = tuple(image) if image is not None else None
+        message = cls(role, content, name, image, image_tokens, pinned, tool_calls, tool_call_id)
+        message.tokens = tokens
+        return message
+
+    def size(self) -> int:
+        """
+        Approximates the number of bytes the message keeps alive.
+        """
+        size = len(self.content) + len(self.name or '')
+        if self.image is not None:
+            size += len(self.image[0])
+        if self.tool_calls is not None:
+            size += sum(len(call['function']['name']) + len(call['function']['arguments']) for call in self.tool_calls)
+        return size
+
+
+class Conversation:
+    """
+    All the state kept for a single conversation.
+    Idle conversations are moved to a colder tier by the store: `warm` ones keep their messages
+    compressed in memory, `cold` ones in the `ColdStore`. Their messages are None until rehydrated.
+    """
+
+    def __init__(self):
+        self.messages: Optional[list[Message]] = []
+        self.token_count = 0  # sum of the tokens of all messages
+        self.size = 0  # approximate bytes of messages, or of the compressed messages
+        self.cost = 0.0
+        self.vision = False
+        self.model: Optional[str] = None  # the model last answering it, None for the configured one
+        self.last_updated = datetime.datetime.now()
+        self.tier = 'hot'
+        self.compressed: Optional[bytes] = None
+
+
+class ColdStore:
+    """
+    Keeps compressed conversations in a local SQLite database.
+    Conversations do not survive restarts, so the database is cleared when opened.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS conversations (chat_id TEXT PRIMARY KEY, data BLOB)')
+        self.connection.execute('DELETE FROM conversations')
+        self.connection.commit()
+
+    def put(self, chat_id, data: bytes) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO conversations VALUES (?, ?)', (str(chat_id), data))
+        self.connection.commit()
+
+    def pop(self, chat_id) -> Optional[bytes]:
+        row = self.connection.execute('SELECT data FROM conversations WHERE chat_id = ?', (str(chat_id),)).fetchone()
+        self.delete(chat_id)
+        return row[0] if row else None
+
+    def delete(self, chat_id) -> None:
+        self.connection.execute('DELETE FROM conversations WHERE chat_id = ?', (str(chat_id),))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ConversationStore:
+    """
+    Holds the conversations by chat ID, evicting the least recently used ones when there are too many
+    or they take too much memory, and the ones that exceeded their maximum age.
+    """
+
+    def __init__(
+        self,
+        max_conversations: int = 0,
+        max_bytes: int = 0,
+        max_age_minutes: int = 0,
+        warm_after_minutes: int = 0,
+        cold_after_minutes: int = 0,
+        cold_store: Optional[ColdStore] = None,
+    ):
+        """
+        :param max_conversations: The maximum number of conversations to keep, 0 for no limit
+        :param max_bytes: The maximum approximate size of all conversations, 0 for no limit
+        :param max_age_minutes: The number of minutes since the last update after which a conversation expires
+        :param warm_after_minutes: The number of idle minutes after which a conversation is compressed, 0 to disable
+        :param cold_after_minutes: The number of idle minutes after which a conversation is moved to the cold store,
+        0 to disable
+        :param cold_store: The store for cold conversations
+        """
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.max_age = datetime.timedelta(minutes=max_age_minutes) if max_age_minutes > 0 else None
+        self.warm_after = datetime.timedelta(minutes=warm_after_minutes) if warm_after_minutes > 0 else None
+        self.cold_after = datetime.timedelta(minutes=cold_after_minutes) if cold_after_minutes > 0 else None
+        self.cold_store = cold_store
+        self.conversations: OrderedDict[str, Conversation] = OrderedDict()
+        self.size = 0
+        self.evictions = {'lru': 0, 'memory': 0, 'age': 0}
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self.conversations
+
+    def __len__(self) -> int:
+        return len(self.conversations)
+
+    def get(self, chat_id) -> Optional[Conversation]:
+        """
+        Gets a conversation and marks it as the most recently used one.
+        :param chat_id: The chat ID
+        :return: The conversation, or None if it does not exist or has expired
+        """
+        conversation = self.conversations.get(chat_id)
+        if conversation is None:
+            return None
+        if self.is_expired(conversation):
+            self.__evict(chat_id, 'age')
+            return None
+        if conversation.tier != 'hot' and not self.__rehydrate(chat_id, conversation):
+            self.pop(chat_id)
+            return None
+        self.conversations.move_to_end(chat_id)
+        return conversation
+
+    def create(self, chat_id) -> Conversation:
+        """
+        Creates an empty conversation, replacing any existing one for the chat ID.
+        :param chat_id: The chat ID
+        :return: The new conversation
+        """
+        self.pop(chat_id)
+        conversation = Conversation()
+        self.conversations[chat_id] = conversation
+        while self.max_conversations and len(self.conversations) > self.max_conversations:
+            self.__evict(next(iter(self.conversations)), 'lru')
+        return conversation
+
+    def pop(self, chat_id) -> Optional[Conversation]:
+        """
+        Removes a conversation.
+        :param chat_id: The chat ID
+        :return: The removed conversation, if any
+        """
+        conversation = self.conversations.pop(chat_id, None)
+        if conversation is not None:
+            self.size -= conversation.size
+            if conversation.tier == 'cold':
+                self.cold_store.delete(chat_id)
+        return conversation
+
+    def append(self, conversation: Conversation, message: Message) -> None:
+        """
+        Appends a message to a conversation and enforces the memory cap.
+        :param conversation: The conversation
+        :param message: The message to append, with its tokens counted
+        """
+        size = message.size()
+        conversation.messages.append(message)
+        conversation.token_count += message.tokens
+        conversation.size += size
+        self.size += size
+        self.__enforce_max_bytes(conversation)
+
+    def replace(self, conversation: Conversation, messages: list[Message]) -> None:
+        """
+        Replaces the messages of a conversation, e.g. after truncating it.
+        :param conversation: The conversation
+        :param messages: The new messages, with their tokens counted
+        """
+        size = sum(message.size() for message in messages)
+        self.size += size - conversation.size
+        conversation.messages = messages
+        conversation.token_count = sum(message.tokens for message in messages)
+        conversation.size = size
+
+    def truncate(self, conversation: Conversation, max_tokens: int, max_messages: int = 0) -> int:
+        """
+        Drops the oldest messages until the conversation fits into a token budget. The system message and
+        the pinned messages are always kept, as well as the last message.
+        :param conversation: The conversation
+        :param max_tokens: The maximum number of tokens of the kept messages
+        :param max_messages: The maximum number of kept messages, 0 for no limit
+        :return: The number of dropped messages
+        """
+        head = conversation.messages[:1] + [message for message in conversation.messages[1:] if message.pinned]
+        rest = [message for message in conversation.messages[1:] if not message.pinned]
+        if not rest:
+            return 0
+        available = max_tokens - sum(message.tokens for message in head)
+        # prefix[i] is the number of tokens of rest[:i], so rest[i:] fits if prefix[-1] - prefix[i] <= available
+        prefix = list(accumulate((message.tokens for message in rest), initial=0))
+        start = bisect.bisect_left(prefix, prefix[-1] - available)
+        if max_messages:
+            start = max(start, len(rest) - (max_messages - len(head)))
+        start = min(start, len(rest) - 1)
+        while start < len(rest) - 1 and rest[start].role == 'tool':
+            start += 1  # tool results cannot be sent without the assistant message requesting them
+        if start <= 0:
+            return 0
+        self.replace(conversation, head + rest[start:])
+        return start
+
+    def is_expired(self, conversation: Conversation, now: Optional[datetime.datetime] = None) -> bool:
+        """
+        Checks if the maximum conversation age has been reached.
+        """
+        if self.max_age is None:
+            return False
+        now = now or datetime.datetime.now()
+        return conversation.last_updated < now - self.max_age
+
+    def expire(self) -> Iterator[bool]:
+        """
+        Removes the conversations that exceeded their maximum age.
+        :return: An iterator yielding True for each removed conversation and False for each kept one
+        """
+        if self.max_age is None:
+            return
+        now = datetime.datetime.now()
+        for chat_id, conversation in list(self.conversations.items()):
+            if self.conversations.get(chat_id) is conversation and self.is_expired(conversation, now):
+                self.__evict(chat_id, 'age')
+                yield True
+            else:
+                yield False
+
+    def demote(self) -> Iterator[bool]:
+        """
+        Compresses the conversations idle for longer than `warm_after` and moves the ones idle
+        for longer than `cold_after` to the cold store.
+        :return: An iterator yielding True for each demoted conversation and False for each kept one
+        """
+        if self.warm_after is None and (self.cold_after is None or self.cold_store is None):
+            return
+        now = datetime.datetime.now()
+        for chat_id, conversation in list(self.conversations.items()):
+            if self.conversations.get(chat_id) is not conversation:
+                yield False
+                continue
+            idle = now - conversation.last_updated
+            if self.cold_after and self.cold_store and conversation.tier != 'cold' and idle > self.cold_after:
+                self.__spill(chat_id, conversation)
+                yield True
+            elif self.warm_after and conversation.tier == 'hot' and idle > self.warm_after:
+                self.__compress(conversation)
+                yield True
+            else:
+                yield False
+
+    def stats(self) -> dict:
+        """
+        Returns the number of conversations by tier, their approximate size and the eviction counters.
+        """
+        tiers = {'hot': 0, 'warm': 0, 'cold': 0}
+        for conversation in self.conversations.values():
+            tiers[conversation.tier] += 1
+        return {
+            'conversations': len(self.conversations),
+            'tiers': tiers,
+            'bytes': self.size,
+            'evictions': dict(self.evictions),
+        }
+
+    def close(self) -> None:
+        """
+        Closes the cold store, if any.
+        """
+        if self.cold_store is not None:
+            self.cold_store.close()
+
+    def __set_size(self, conversation: Conversation, size: int) -> None:
+        self.size += size - conversation.size
+        conversation.size = size
+
+    def __compress(self, conversation: Conversation) -> None:
+        records = [message.to_record() for message in conversation.messages]
+        conversation.compressed = zlib.compress(json.dumps(records).encode('utf-8'))
+        conversation.messages = None
+        conversation.tier = 'warm'
+        self.__set_size(conversation, len(conversation.compressed))
+
+    def __spill(self, chat_id, conversation: Conversation) -> None:
+        if conversation.tier == 'hot':
+            self.__compress(conversation)
+        self.cold_store.put(chat_id, conversation.compressed)
+        conversation.compressed = None
+        conversation.tier = 'cold'
+        self.__set_size(conversation, 0)
+
+    def __rehydrate(self, chat_id, conversation: Conversation) -> bool:
+        data = self.cold_store.pop(chat_id) if conversation.tier == 'cold' else conversation.compressed
+        conversation.tier = 'hot'
+        conversation.compressed = None
+        if data is None:
+            logging.warning(f'Conversation {chat_id} is missing from the cold store')
+            return False
+        records = json.loads(zlib.decompress(data).decode('utf-8'))
+        conversation.messages = [Message.from_record(record) for record in records]
+        self.__set_size(conversation, sum(message.size() for message in conversation.messages))
+        return True
+
+    def __enforce_max_bytes(self, current: Conversation) -> None:
+        while self.max_bytes and self.size > self.max_bytes:
+            chat_id, oldest = next(iter(self.conversations.items()))
+            if oldest is current:
+                break
+            self.__evict(chat_id, 'memory')
+
+    def __evict(self, chat_id, reason: str) -> None:
+        self.pop(chat_id)
+        self.evictions[reason] += 1
+        logging.debug(f'Evicted conversation {chat_id} ({reason}), {len(self.conversations)} left')
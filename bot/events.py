@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+
+@dataclass
+class TextDelta:
+    """
+    A piece of the answer, as streamed by the model.
+    """
+
+    text: str
+
+
+@dataclass
+class StreamEnd:
+    """
+    The end of a streamed answer, with the footer to append to it and the number of tokens used.
+    """
+
+    footer: str
+    tokens: int
+
+
+@dataclass
+class DirectResult:
+    """
+    A plugin result to send directly to the user instead of an answer, e.g. a photo or a voice message,
+    with the number of tokens used to get it.
+    """
+
+    kind: str
+    value: Any
+    tokens: int = 0
+
+    @classmethod
+    def from_plugin_response(cls, response) -> Optional[DirectResult]:
+        """
+        Gets the direct result of a plugin response, i.e. a dict with a `direct_result` entry.
+        :param response: The plugin response
+        :return: The direct result, or None if the response is to be sent to the model
+        """
+        if not isinstance(response, dict) or not isinstance(response.get('direct_result'), dict):
+            return None
+        result = response['direct_result']
+        return cls(kind=result['kind'], value=result['value'])
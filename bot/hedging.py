@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class LatencyTracker:
+    """
+    Keeps the most recent latencies of each kind of request, to derive a hedging deadline from their
+    95th percentile: a request still waiting past it is slower than 95% of the recent ones.
+    """
+
+    def __init__(self, window: int = 100, min_samples: int = 20, default_seconds: float = 10, min_seconds: float = 1):
+        """
+        :param window: The number of recent latencies kept per kind of request
+        :param min_samples: The number of latencies needed before the percentile is used
+        :param default_seconds: The deadline until enough latencies were recorded
+        :param min_seconds: The minimum deadline, so that fast requests are not hedged for small delays
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self.default_seconds = default_seconds
+        self.min_seconds = min_seconds
+        self.samples: dict[Hashable, deque] = {}
+
+    def record(self, key: Hashable, seconds: float) -> None:
+        self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def deadline(self, key: Hashable) -> float:
+        """
+        Gets the number of seconds after which a request of the given kind is hedged.
+        """
+        samples = self.samples.get(key, ())
+        if len(samples) < self.min_samples:
+            return self.default_seconds
+        p95 = sorted(samples)[int(0.95 * (len(samples) - 1))]
+        return max(p95, self.min_seconds)
+
+
+async def hedged(
+    attempt: Callable[[str], Awaitable],
+    model: str,
+    hedge_model: str,
+    deadline: float,
+) -> tuple[Any, str]:
+    """
+    Runs a request, and a second one if the first did not complete before the deadline.
+    The first one to succeed wins and the other one is cancelled, or closed if it is a stream that
+    also succeeded, so that its connection is released right away.
+    :param attempt: The function sending the request to the given model
+    :param model: The model to send the request to
+    :param hedge_model: The model to send the second request to, possibly the same one
+    :param deadline: The number of seconds to wait for the first request before hedging it
+    :return: The result of the winning request and its model
+    :raises Exception: The error of the last failed request, if both failed
+    """
+    tasks = {asyncio.ensure_future(attempt(model)): model}
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=deadline)
+        if not done:
+            logging.info(f'No response from {model} after {deadline:.1f}s, hedging with {hedge_model}')
+            tasks[asyncio.ensure_future(attempt(hedge_model))] = hedge_model
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result(), tasks[task]
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None and hasattr(task.result(), 'aclose'):
+                await task.result().aclose()
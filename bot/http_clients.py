@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Iterable, Optional
+
+import httpx
+
+
+class HttpClients:
+    """
+    The HTTP clients shared by the whole process, one per proxy, so that the OpenAI clients and the plugins
+    reuse kept-alive connections instead of paying DNS, TCP and TLS for every request.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_seconds: float = 30,
+        http2: bool = False,
+    ):
+        """
+        :param max_connections: The maximum number of connections of each client
+        :param max_keepalive_connections: The maximum number of idle connections kept alive by each client
+        :param keepalive_seconds: The number of seconds an idle connection is kept alive
+        :param http2: Whether to use HTTP/2 where the server supports it, requires the `h2` package
+        """
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_seconds,
+        )
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logging.warning('HTTP/2 is enabled but the h2 package is not installed, using HTTP/1.1')
+                http2 = False
+        self.http2 = http2
+        self.clients: dict[Optional[str], httpx.AsyncClient] = {}
+
+    def get(self, proxy: Optional[str] = None) -> httpx.AsyncClient:
+        """
+        Gets the shared client for the given proxy, creating it on first use.
+        :param proxy: The proxy URL, None for direct connections
+        :return: The client, not to be closed by the caller
+        """
+        client = self.clients.get(proxy)
+        if client is None:
+            client = httpx.AsyncClient(proxies=proxy, limits=self.limits, http2=self.http2)
+            self.clients[proxy] = client
+        return client
+
+    async def prewarm(self, urls: Iterable[str], proxy: Optional[str] = None) -> None:
+        """
+        Opens connections to the given URLs ahead of the first requests, ignoring failures.
+        :param urls: The URLs, typically the base URLs of the APIs used
+        :param proxy: The proxy URL, None for direct connections
+        """
+        client = self.get(proxy)
+        urls = list(urls)
+        results = await asyncio.gather(*(client.head(url, timeout=5) for url in urls), return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                logging.debug(f'Could not pre-warm a connection to {url}: {result}')
+
+    async def aclose(self) -> None:
+        """
+        Closes all clients and their connections.
+        """
+        await asyncio.gather(*(client.aclose() for client in self.clients.values()))
+        self.clients.clear()
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -34,8 +35,31 @@ def main():
         'show_usage': os.environ.get('SHOW_USAGE', 'false').lower() == 'true',
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
+        'api_max_attempts': int(os.environ.get('API_MAX_ATTEMPTS', 3)),
+        'api_max_retry_delay_seconds': float(os.environ.get('API_MAX_RETRY_DELAY_SECONDS', 30)),
+        'circuit_breaker_threshold': int(os.environ.get('CIRCUIT_BREAKER_THRESHOLD', 5)),
+        'circuit_breaker_reset_seconds': float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30)),
+        'requests_per_minute': int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 0)),
+        'tokens_per_minute': int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', 0)),
+        'pool': json.loads(os.environ.get('OPENAI_POOL', '[]')),
+        'http_max_connections': int(os.environ.get('HTTP_MAX_CONNECTIONS', 100)),
+        'http_max_keepalive_connections': int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20)),
+        'http_keepalive_seconds': float(os.environ.get('HTTP_KEEPALIVE_SECONDS', 30)),
+        'http2': os.environ.get('HTTP2', 'false').lower() == 'true',
+        'http_prewarm': os.environ.get('HTTP_PREWARM', 'true').lower() == 'true',
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
+        'context_strategy': os.environ.get('CONTEXT_STRATEGY', 'summarise'),
+        'summarise_threshold': float(os.environ.get('SUMMARISE_THRESHOLD', 0)),
+        'summary_model': os.environ.get('SUMMARY_MODEL', model),
+        'summary_max_input_tokens': int(os.environ.get('SUMMARY_MAX_INPUT_TOKENS', 3000)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'max_conversations': int(os.environ.get('MAX_CONVERSATIONS', 10000)),
+        'max_conversations_memory_mb': int(os.environ.get('MAX_CONVERSATIONS_MEMORY_MB', 256)),
+        'conversation_warm_after_minutes': int(os.environ.get('CONVERSATION_WARM_AFTER_MINUTES', 0)),
+        'conversation_cold_after_minutes': int(os.environ.get('CONVERSATION_COLD_AFTER_MINUTES', 0)),
+        'conversation_cold_store_path': os.environ.get('CONVERSATION_COLD_STORE_PATH', 'conversations.sqlite3'),
+        'image_store_memory_mb': int(os.environ.get('IMAGE_STORE_MEMORY_MB', 64)),
+        'image_store_path': os.environ.get('IMAGE_STORE_PATH', 'image_store'),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -60,6 +84,20 @@ def main():
         'vision_max_tokens': int(os.environ.get('VISION_MAX_TOKENS', '300')),
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_voice': os.environ.get('TTS_VOICE', 'alloy'),
+        'inline_cache_size': int(os.environ.get('INLINE_CACHE_SIZE', 0)),
+        'inline_cache_ttl_minutes': int(os.environ.get('INLINE_CACHE_TTL_MINUTES', 60)),
+        'inline_cache_max_temperature': float(os.environ.get('INLINE_CACHE_MAX_TEMPERATURE', 0.3)),
+        'inline_cache_always': os.environ.get('INLINE_CACHE_ALWAYS', 'false').lower() == 'true',
+        'semantic_cache_size': int(os.environ.get('SEMANTIC_CACHE_SIZE', 0)),
+        'semantic_cache_threshold': float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+        'semantic_cache_ttl_minutes': int(os.environ.get('SEMANTIC_CACHE_TTL_MINUTES', 1440)),
+        'semantic_cache_path': os.environ.get('SEMANTIC_CACHE_PATH', 'semantic_cache.npy'),
+        'embedding_model': os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small'),
+        'fallback_models': [model for model in os.environ.get('FALLBACK_MODELS', '').split(',') if model],
+        'hedge_requests': os.environ.get('HEDGE_REQUESTS', 'false').lower() == 'true',
+        'hedge_deadline_seconds': float(os.environ.get('HEDGE_DEADLINE_SECONDS', 10)),
+        'hedge_min_samples': int(os.environ.get('HEDGE_MIN_SAMPLES', 20)),
+        'model_routes': json.loads(os.environ.get('MODEL_ROUTES', '[]')),
         'allowed_chat_ids_to_track': set(os.environ.get('ALLOWED_CHAT_IDS_TO_TRACK', '').split(',')),
     }
 
@@ -108,9 +146,14 @@ def main():
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
         'database_url': os.environ.get('DATABASE_URL_TO_DROP_ALL_TABLES'),
+        'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'sweep_interval_seconds': int(os.environ.get('SWEEP_INTERVAL_SECONDS', 300)),
     }
 
-    plugin_config = {'plugins': os.environ.get('PLUGINS', '').split(',')}
+    plugin_config = {
+        'plugins': os.environ.get('PLUGINS', '').split(','),
+        'plugin_cache_size': int(os.environ.get('PLUGIN_CACHE_SIZE', 1000)),
+    }
 
     # Setup and run ChatGPT and Telegram bot
     plugin_manager = PluginManager(config=plugin_config)
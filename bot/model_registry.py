@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+
+import tiktoken
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """
+    Capabilities, token accounting and pricing of a chat model.
+    Prices are in USD per 1M tokens.
+    """
+
+    name: str
+    context_window: int
+    default_max_tokens: int
+    tokens_per_message: int = 3
+    tokens_per_name: int = 1
+    functions: bool = True
+    vision: bool = False
+    encoding_name: str = 'cl100k_base'
+    prompt_price: float = 0.0
+    completion_price: float = 0.0
+    encoding: tiktoken.Encoding = field(default=None, init=False, repr=False, compare=False)
+
+    def get_encoding(self) -> tiktoken.Encoding:
+        """
+        Returns the tiktoken encoding of the model, loading it on first use.
+        """
+        if self.encoding is None:
+            object.__setattr__(self, 'encoding', tiktoken.get_encoding(self.encoding_name))
+        return self.encoding
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        """
+        Computes the USD cost of a request.
+        :param prompt_tokens: The number of prompt tokens
+        :param completion_tokens: The number of completion tokens
+        :return: The cost in USD
+        """
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1_000_000
+
+
+def _profiles(names, **kwargs) -> dict[str, ModelProfile]:
+    return {name: ModelProfile(name=name, **kwargs) for name in names}
+
+
+# Models can be found here: https://platform.openai.com/docs/models/overview
+# Pricing can be found here: https://openai.com/api/pricing/
+_GPT_3 = {
+    'tokens_per_message': 4,  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+    'tokens_per_name': -1,  # if there's a name, the role is omitted
+    'prompt_price': 0.5,
+    'completion_price': 1.5,
+}
+MODEL_PROFILES: dict[str, ModelProfile] = {
+    **_profiles(('gpt-3.5-turbo',), context_window=4096, default_max_tokens=1200, **_GPT_3),
+    # Deprecated snapshots without function calling
+    **_profiles(
+        ('gpt-3.5-turbo-0301', 'gpt-3.5-turbo-0613'),
+        context_window=4096,
+        default_max_tokens=1200,
+        functions=False,
+        **_GPT_3,
+    ),
+    **_profiles(
+        ('gpt-3.5-turbo-16k', 'gpt-3.5-turbo-0125'),
+        context_window=16384,
+        default_max_tokens=4800,
+        **_GPT_3,
+    ),
+    **_profiles(('gpt-3.5-turbo-16k-0613',), context_window=16384, default_max_tokens=4800, functions=False, **_GPT_3),
+    **_profiles(('gpt-3.5-turbo-1106',), context_window=16384, default_max_tokens=4096, **_GPT_3),
+    **_profiles(
+        ('gpt-4', 'gpt-4-0613'),
+        context_window=8192,
+        default_max_tokens=2400,
+        prompt_price=30,
+        completion_price=60,
+    ),
+    **_profiles(
+        ('gpt-4-0314',),
+        context_window=8192,
+        default_max_tokens=2400,
+        functions=False,
+        prompt_price=30,
+        completion_price=60,
+    ),
+    **_profiles(
+        ('gpt-4-32k', 'gpt-4-32k-0613'),
+        context_window=32768,
+        default_max_tokens=9600,
+        prompt_price=60,
+        completion_price=120,
+    ),
+    **_profiles(
+        ('gpt-4-32k-0314',),
+        context_window=32768,
+        default_max_tokens=9600,
+        functions=False,
+        prompt_price=60,
+        completion_price=120,
+    ),
+    **_profiles(
+        ('gpt-4-1106-preview', 'gpt-4-0125-preview', 'gpt-4-turbo-preview'),
+        context_window=126976,
+        default_max_tokens=4096,
+        prompt_price=10,
+        completion_price=30,
+    ),
+    **_profiles(
+        ('gpt-4-turbo', 'gpt-4-turbo-2024-04-09'),
+        context_window=126976,
+        default_max_tokens=4096,
+        vision=True,
+        prompt_price=10,
+        completion_price=30,
+    ),
+    **_profiles(
+        ('gpt-4-vision-preview',),
+        context_window=126976,
+        default_max_tokens=4096,
+        functions=False,
+        vision=True,
+        prompt_price=10,
+        completion_price=30,
+    ),
+    **_profiles(
+        ('gpt-4o',),
+        context_window=126976,
+        default_max_tokens=4096,
+        vision=True,
+        encoding_name='o200k_base',
+        prompt_price=5,
+        completion_price=15,
+    ),
+    **_profiles(
+        ('gpt-4o-mini',),
+        context_window=126976,
+        default_max_tokens=4096,
+        vision=True,
+        encoding_name='o200k_base',
+        prompt_price=0.15,
+        completion_price=0.6,
+    ),
+}
+
+_resolved: dict[str, ModelProfile] = {}
+
+
+def get_model_profile(model: str) -> ModelProfile:
+    """
+    Gets the profile of a model. Dated snapshots (e.g. `gpt-4o-2024-08-06`) resolve to the
+    longest registered prefix, unknown models to a conservative default profile.
+    The result is cached, so repeated lookups are a single dict hit.
+    :param model: The model name
+    :return: The model profile
+    """
+    profile = _resolved.get(model)
+    if profile is not None:
+        return profile
+
+    profile = MODEL_PROFILES.get(model)
+    if profile is None:
+        prefixes = [name for name in MODEL_PROFILES if model.startswith(f'{name}-')]
+        if prefixes:
+            profile = MODEL_PROFILES[max(prefixes, key=len)]
+        else:
+            logging.warning(f'Model {model} is not registered, using a default profile for it')
+            profile = ModelProfile(name=model, context_window=4096, default_max_tokens=1200)
+    _resolved[model] = profile
+    return profile
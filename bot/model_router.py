@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import logging
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+from model_registry import get_model_profile
+
+_CODE = re.compile(
+    r'```|^\s*(def|class|import|from|function|const|let|var|public|private|return|#include|SELECT)\b'
+    r'|[;{}]\s*$|=>|\w+\([^()]*\)\s*[:{]',
+    re.MULTILINE,
+)
+_REASONING = re.compile(
+    r'\b(why|how come|explain|prove|derive|analy[sz]e|compare|evaluate|design|architect\w*|optimi[sz]e'
+    r'|debug|refactor|step by step|trade-?offs?|pros and cons)\b',
+    re.IGNORECASE,
+)
+_MATH = re.compile(r'[=∑∫√^]|\d+\s*[-+*/]\s*\d+')
+
+# Parts of plugin function names too generic to tell that a query is about the plugin
+_GENERIC_WORDS = {'answer', 'current', 'currently', 'lookup', 'query', 'react', 'send', 'text', 'users', 'with'}
+
+
+def has_code(text: str) -> bool:
+    """
+    Whether the text looks like it contains source code.
+    """
+    return _CODE.search(text) is not None
+
+
+def complexity_score(text: str) -> float:
+    """
+    A lightweight local classifier of how demanding a query is, from its length, reasoning keywords,
+    code and math, without calling any model.
+    :return: A score between 0 for chit-chat and 1 for queries needing a strong model
+    """
+    score = -2.0
+    score += 0.6 * math.log1p(len(text.split()) / 10)
+    score += 1.2 * min(len(_REASONING.findall(text)), 3)
+    score += 1.5 if has_code(text) else 0
+    score += 0.8 if _MATH.search(text) else 0
+    score += 0.3 * min(text.count('?'), 3)
+    return 1 / (1 + math.exp(-score))
+
+
+@dataclass(frozen=True)
+class RoutingDecision:
+    """
+    The model chosen to answer a request, and the name of the rule that chose it.
+    """
+
+    model: str
+    reason: str
+
+
+class ModelRouter:
+    """
+    Picks the model answering each chat request from a list of rules, so that short chit-chat can go to
+    a cheaper, faster model than demanding queries. The first rule matching the request wins, the default
+    model answers if none does. A rule matches if all its conditions hold:
+    - `chats`: the chat ID is one of the given ones, to override the model of some chats
+    - `min_prompt_tokens`, `max_prompt_tokens`: bounds of the number of tokens of the conversation
+    - `code`: whether the query contains code
+    - `plugins`: whether the query likely needs a plugin, i.e. mentions what a plugin function is about
+    - `min_complexity`, `max_complexity`: bounds of the score of the classifier, between 0 and 1
+    Rules whose model cannot fit the conversation and the completion into its context window are skipped.
+    """
+
+    def __init__(
+        self,
+        default_model: str,
+        rules: list[dict],
+        max_completion_tokens: int,
+        plugin_functions: Iterable[str] = (),
+        classifier: Callable[[str], float] = complexity_score,
+    ):
+        """
+        :param default_model: The model answering the requests matching no rule
+        :param rules: The rules, each one with a `model`, an optional `name` and its conditions
+        :param max_completion_tokens: The maximum number of tokens of a completion
+        :param plugin_functions: The names of the plugin functions, whose words tell that a plugin is likely used
+        :param classifier: The function scoring how demanding a query is
+        """
+        self.default_model = default_model
+        self.rules = rules
+        self.max_completion_tokens = max_completion_tokens
+        self.classifier = classifier
+        words = {word for name in plugin_functions for word in name.lower().split('_')}
+        words = sorted(word for word in words if len(word) >= 4 and word not in _GENERIC_WORDS)
+        self.plugin_pattern = re.compile(rf"\b({'|'.join(words)})", re.IGNORECASE) if words else None
+        self.decisions: Counter = Counter()  # by (model, reason)
+
+    def likely_uses_plugins(self, query: str) -> bool:
+        """
+        Whether the query mentions what one of the plugin functions is about, e.g. the weather.
+        """
+        return self.plugin_pattern is not None and self.plugin_pattern.search(query) is not None
+
+    def route(self, chat_id, query: str, prompt_tokens: int) -> RoutingDecision:
+        """
+        Picks the model answering a request.
+        :param chat_id: The chat ID
+        :param query: The query to answer
+        :param prompt_tokens: The number of tokens of the conversation, including the query
+        :return: The decision
+        """
+        decision = RoutingDecision(self.default_model, 'default')
+        features = {}  # computed on first use, as most rules only need some of them
+        for i, rule in enumerate(self.rules):
+            if self.__matches(rule, chat_id, query, prompt_tokens, features):
+                decision = RoutingDecision(rule['model'], rule.get('name', f'rule {i + 1}'))
+                break
+
+        self.decisions[decision] += 1
+        logging.debug(f'Routing chat ID {chat_id} to {decision.model} ({decision.reason})')
+        return decision
+
+    def __matches(self, rule: dict, chat_id, query: str, prompt_tokens: int, features: dict) -> bool:
+        if 'chats' in rule and str(chat_id) not in {str(chat) for chat in rule['chats']}:
+            return False
+        if not rule.get('min_prompt_tokens', 0) <= prompt_tokens <= rule.get('max_prompt_tokens', math.inf):
+            return False
+        if prompt_tokens + self.max_completion_tokens > get_model_profile(rule['model']).context_window:
+            return False
+        if 'code' in rule and self.__feature('code', query, features) != rule['code']:
+            return False
+        if 'plugins' in rule and self.__feature('plugins', query, features) != rule['plugins']:
+            return False
+        if 'min_complexity' in rule or 'max_complexity' in rule:
+            complexity = self.__feature('complexity', query, features)
+            if not rule.get('min_complexity', 0) <= complexity <= rule.get('max_complexity', 1):
+                return False
+        return True
+
+    def __feature(self, name: str, query: str, features: dict):
+        if name not in features:
+            extract = {'code': has_code, 'plugins': self.likely_uses_plugins, 'complexity': self.classifier}[name]
+            features[name] = extract(query)
+        return features[name]
+
+    def stats(self) -> dict:
+        """
+        Returns the number of requests routed to each model and by each rule.
+        """
+        models, reasons = Counter(), Counter()
+        for decision, count in self.decisions.items():
+            models[decision.model] += count
+            reasons[decision.reason] += count
+        return {'models': dict(models), 'rules': dict(reasons)}
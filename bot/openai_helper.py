@@ -1,51 +1,84 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
 import io
 import json
 import logging
 import os
-from typing import Optional, TypedDict
+import sys
+import time
+from typing import Optional
 
-import httpx
 import openai
-import tiktoken
-from openai._utils import async_maybe_transform
-from openai.types.chat import ChatCompletionMessageParam
+from blob_store import BlobStore
+from cache import TTLCache
+from client_pool import ClientPool, close_stream
+from conversation_store import ColdStore, ConversationStore, Message
+from events import DirectResult, StreamEnd, TextDelta
+from hedging import LatencyTracker, hedged
+from http_clients import HttpClients
+from model_registry import get_model_profile
+from model_router import ModelRouter
 from PIL import Image
 from plugin_manager import PluginManager
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
-from utils import decode_image, encode_image, is_direct_result
-
-# Models can be found here: https://platform.openai.com/docs/models/overview
-# Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
-GPT_3_MODELS = ('gpt-3.5-turbo', 'gpt-3.5-turbo-0301', 'gpt-3.5-turbo-0613')
-GPT_3_16K_MODELS = (
-    'gpt-3.5-turbo-16k',
-    'gpt-3.5-turbo-16k-0613',
-    'gpt-3.5-turbo-1106',
-    'gpt-3.5-turbo-0125',
-)
-GPT_4_MODELS = ('gpt-4', 'gpt-4-0314', 'gpt-4-0613', 'gpt-4-turbo-preview')
-GPT_4_32K_MODELS = ('gpt-4-32k', 'gpt-4-32k-0314', 'gpt-4-32k-0613')
-GPT_4_VISION_MODELS = ('gpt-4-vision-preview', 'gpt-4o', 'gpt-4o-mini')
-GPT_4_128K_MODELS = (
-    'gpt-4-1106-preview',
-    'gpt-4-0125-preview',
-    'gpt-4-turbo-preview',
-    'gpt-4-turbo',
-    'gpt-4-turbo-2024-04-09',
-)
-GPT_4O_MODELS = ('gpt-4o', 'gpt-4o-mini')
-GPT_ALL_MODELS = (
-    GPT_3_MODELS
-    + GPT_3_16K_MODELS
-    + GPT_4_MODELS
-    + GPT_4_32K_MODELS
-    + GPT_4_VISION_MODELS
-    + GPT_4_128K_MODELS
-    + GPT_4O_MODELS
-)
+from resilience import CircuitOpenError
+from semantic_cache import SemanticCache
+from transcript import render_transcript
+
+
+async def _prepend(items: list, stream):
+    """
+    Yields the given items, then the items of the given stream, which is closed once done or abandoned.
+    """
+    try:
+        for item in items:
+            yield item
+        async for item in stream:
+            yield item
+    finally:
+        await close_stream(stream)
+
+
+class _Replay:
+    """
+    A streamed response whose already received chunks are given back before the rest of it.
+    It can only be iterated once, as it owns the stream: iterating it again continues where it stopped,
+    and closing it closes the stream, even if it was never iterated, e.g. when it lost a hedged request.
+    """
+
+    def __init__(self, items: list, stream):
+        self.items = list(items)
+        self.stream = stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.items:
+            return self.items.pop(0)
+        return await self.stream.__anext__()
+
+    async def aclose(self) -> None:
+        await close_stream(self.stream)
+
+
+async def _first_token(stream) -> _Replay:
+    """
+    Waits for the first chunk of a streamed completion carrying content, tool calls or a finish reason.
+    :return: The stream, with its already received chunks given back
+    """
+    items = []
+    try:
+        async for item in stream:
+            items.append(item)
+            choice = item.choices[0] if item.choices else None
+            if choice and (choice.finish_reason or choice.delta and (choice.delta.content or choice.delta.tool_calls)):
+                break
+    except BaseException:
+        await close_stream(stream)  # e.g. cancelled when the hedged request won
+        raise
+    return _Replay(items, stream)
 
 
 def default_max_tokens(model: str) -> int:
@@ -54,49 +87,14 @@ def default_max_tokens(model: str) -> int:
     :param model: The model name
     :return: The default number of max tokens
     """
-    base = 1200
-    if model in GPT_3_MODELS:
-        return base
-    elif model in GPT_4_MODELS:
-        return base * 2
-    elif model in GPT_3_16K_MODELS:
-        if model == 'gpt-3.5-turbo-1106':
-            return 4096
-        return base * 4
-    elif model in GPT_4_32K_MODELS:
-        return base * 8
-    elif model in GPT_4_VISION_MODELS:
-        return 4096
-    elif model in GPT_4_128K_MODELS:
-        return 4096
-    elif model in GPT_4O_MODELS:
-        return 4096
+    return get_model_profile(model).default_max_tokens
 
 
 def are_functions_available(model: str) -> bool:
     """
     Whether the given model supports functions
     """
-    # Deprecated models
-    if model in ('gpt-3.5-turbo-0301', 'gpt-4-0314', 'gpt-4-32k-0314'):
-        return False
-    # Stable models will be updated to support functions on June 27, 2023
-    if model in (
-        'gpt-3.5-turbo',
-        'gpt-3.5-turbo-1106',
-        'gpt-4',
-        'gpt-4-32k',
-        'gpt-4-1106-preview',
-        'gpt-4-0125-preview',
-        'gpt-4-turbo-preview',
-    ):
-        return datetime.date.today() > datetime.date(2023, 6, 27)
-    # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
-    if model in ('gpt-3.5-turbo-0613', 'gpt-3.5-turbo-16k-0613'):
-        return datetime.date.today() < datetime.date(2024, 6, 13)
-    if model == 'gpt-4-vision-preview':
-        return False
-    return True
+    return get_model_profile(model).functions
 
 
 # Load translations
@@ -135,20 +133,69 @@ class OpenAIHelper:
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
         """
-        http_client = httpx.AsyncClient(proxies=config['proxy']) if 'proxy' in config else None
-        self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
+        self.http_clients = HttpClients(
+            max_connections=config.get('http_max_connections', 100),
+            max_keepalive_connections=config.get('http_max_keepalive_connections', 20),
+            keepalive_seconds=config.get('http_keepalive_seconds', 30),
+            http2=config.get('http2', False),
+        )
+        self.clients = ClientPool.from_config(config, self.http_clients)
+        self.latencies = LatencyTracker(
+            min_samples=config.get('hedge_min_samples', 20),
+            default_seconds=config.get('hedge_deadline_seconds', 10),
+        )
+        self.inline_cache = TTLCache(config.get('inline_cache_size', 0))
+        functions = plugin_manager.get_functions_specs() if config['enable_functions'] else []
+        self.router = ModelRouter(
+            default_model=config['model'],
+            rules=config.get('model_routes', []),
+            max_completion_tokens=config['max_tokens'],
+            plugin_functions=[spec['name'] for spec in functions],
+        )
+        self.semantic_cache = None
+        if config.get('semantic_cache_size', 0) and not SemanticCache.is_available():
+            logging.warning('The semantic cache is enabled but NumPy is not installed, disabling it')
+        elif config.get('semantic_cache_size', 0):
+            embedding_model = config.get('embedding_model', 'text-embedding-3-small')
+            self.semantic_cache = SemanticCache(
+                embed=self.__embed,
+                max_size=config['semantic_cache_size'],
+                ttl_seconds=config.get('semantic_cache_ttl_minutes', 1440) * 60,
+                threshold=config.get('semantic_cache_threshold', 0.95),
+                path=config.get('semantic_cache_path'),
+                namespace='\n'.join((config['model'], config['assistant_prompt'], embedding_model)),
+            )
 
         self.db_pool = None
 
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int:list] = {}  # {chat_id: history}
-        self.conversations_costs: dict[int:float] = {}  # {chat_id: cost}
-        self.conversations_vision: dict[int:bool] = {}  # {chat_id: is_vision}
-        self.last_updated: dict[int:datetime] = {}  # {chat_id: last_update_timestamp}
+        self.model_profile = get_model_profile(config['model'])
+        self.vision_model_profile = get_model_profile(config['vision_model'])
+        self.model_profile.get_encoding()
+        cold_after_minutes = config.get('conversation_cold_after_minutes', 0)
+        self.conversations = ConversationStore(
+            max_conversations=config.get('max_conversations', 0),
+            max_bytes=config.get('max_conversations_memory_mb', 0) * 1024 * 1024,
+            max_age_minutes=config['max_conversation_age_minutes'],
+            warm_after_minutes=config.get('conversation_warm_after_minutes', 0),
+            cold_after_minutes=cold_after_minutes,
+            cold_store=ColdStore(config['conversation_cold_store_path']) if cold_after_minutes > 0 else None,
+        )
+        self.blobs = BlobStore(
+            max_memory_bytes=config.get('image_store_memory_mb', 0) * 1024 * 1024,
+            directory=config['image_store_path'],
+            max_age_seconds=config['max_conversation_age_minutes'] * 60,
+        )
+        self.summarising: dict[str, asyncio.Task] = {}  # background summaries in progress, by chat ID
+        self.background_tasks: set[asyncio.Task] = set()
 
-    class MessageDb(TypedDict, total=False):
-        message: ChatCompletionMessageParam
+    async def prewarm(self) -> None:
+        """
+        Opens the connections to the OpenAI API ahead of the first requests, if enabled.
+        """
+        if self.config.get('http_prewarm', False):
+            await self.http_clients.prewarm(self.clients.base_urls, self.config.get('proxy'))
 
     async def init_conv_in_db(self, chat_id: str) -> None:
         if not self.db_pool:
@@ -198,9 +245,8 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
-            await self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        conversation = self.conversations.get(chat_id) or await self.reset_chat_history(chat_id)
+        return len(conversation.messages), self.__conversation_token_count(conversation)
 
     async def get_chat_response(self, chat_id: str, query: str) -> tuple[str, str]:
         """
@@ -209,12 +255,22 @@ class OpenAIHelper:
         :param query: The query to send to the model
         :return: The answer from the model and the number of tokens used
         """
+        cached_answer, embedding = await self.__semantic_lookup(chat_id, query)
+        if cached_answer is not None:
+            return cached_answer, 0
+
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
-            if is_direct_result(response):
-                return response, '0'
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+        started = time.monotonic()
+        response, route, answered_by = await self.__common_get_chat_response(chat_id, query)
+        if self.config['enable_functions'] and not self.__is_vision(chat_id):
+            response, plugins_used, usage, answered_by = await self.__handle_function_call(
+                chat_id, response, started=started, model=route.model, answered_by=answered_by
+            )
+            if isinstance(response, DirectResult):
+                return response, response.tokens
+        self.__add_usage(usage, response, answered_by)
+        total_tokens = usage['prompt_tokens'] + usage['completion_tokens']
 
         answer = ''
 
@@ -229,33 +285,93 @@ class OpenAIHelper:
         else:
             answer = response.choices[0].message.content.strip()
             await self.__add_to_history(chat_id, role='assistant', content=answer)
+            if embedding is not None and not plugins_used:
+                self.semantic_cache.add(embedding, answer)
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            # gpt 4o-mini
-            cost = (0.00000015 * response.usage.prompt_tokens) + (0.0000006 * response.usage.completion_tokens)
-
-            # gpt 4o
-            # cost = (0.000005 * response.usage.prompt_tokens) + (0.000015 * response.usage.completion_tokens)
-
-            self.add_cost(chat_id, cost)
+            self.add_cost(chat_id, usage['cost'])
             total_cost = self.get_cost(chat_id)
             price = f'¢{total_cost * 100:.2f}' if total_cost >= 1e-4 else ''
             answer += f'\n\n---\nID: {chat_id[-2:]} {price}'
+            answer += self.__route_footer(route, answered_by)
 
             # bot_language = self.config['bot_language']
             # answer += (
             #     "\n\n---\n"
-            #     f"ID: {chat_id[-2:]} 💰 {str(response.usage.total_tokens)} {localized_text('stats_tokens', bot_language)}"
-            #     f" ({str(response.usage.prompt_tokens)} {localized_text('prompt', bot_language)},"
-            #     f" {str(response.usage.completion_tokens)} {localized_text('completion', bot_language)})"
+            #     f"ID: {chat_id[-2:]} 💰 {str(total_tokens)} {localized_text('stats_tokens', bot_language)}"
+            #     f" ({str(usage['prompt_tokens'])} {localized_text('prompt', bot_language)},"
+            #     f" {str(usage['completion_tokens'])} {localized_text('completion', bot_language)})"
             # )
             if show_plugins_used:
                 answer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
             answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
+        return answer, total_tokens
+
+    def is_inline_cacheable(self) -> bool:
+        """
+        Whether inline queries are answered from the response cache, i.e. if it is enabled and either
+        the temperature is low enough for answers to be reused, or caching is forced.
+        """
+        if not self.inline_cache.max_size:
+            return False
+        return self.config.get('inline_cache_always', False) or self.config['temperature'] <= self.config.get(
+            'inline_cache_max_temperature', 0.3
+        )
+
+    async def get_inline_response(self, chat_id: str, query: str) -> tuple[str, int]:
+        """
+        Gets a response to an inline query from the response cache, or from the GPT model.
+        The query is answered on its own, without the conversation history nor plugins,
+        so that the answer only depends on the cache key and does not end up in the history.
+        :param chat_id: The chat ID
+        :param query: The query to send to the model
+        :return: The answer and the number of tokens used, 0 if it was cached
+        """
+        key = (
+            self.config['model'],
+            self.config['assistant_prompt'],
+            ' '.join(query.casefold().split()),
+            self.config['temperature'],
+        )
+        answer = self.inline_cache.get(key)
+        if answer is not None:
+            return answer, 0
+
+        bot_language = self.config['bot_language']
+        try:
+            messages = [Message('system', self.config['assistant_prompt']), Message('user', query)]
+            tokens = self.__count_tokens(messages) + self.config['max_tokens']
+            response = await self.clients.request(
+                'chat.completions.create',
+                tokens,
+                chat_id,
+                model=self.config['model'],
+                messages=[message.to_dict() for message in messages],
+                temperature=self.config['temperature'],
+                max_tokens=self.config['max_tokens'],
+                presence_penalty=self.config['presence_penalty'],
+                frequency_penalty=self.config['frequency_penalty'],
+            )
+
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(bot_language) from e
+
+        except openai.RateLimitError as e:
+            raise Exception(f"⚠️ _{localized_text('openai_rate_limit', bot_language)}._ ⚠️\n{str(e)}") from e
+
+        except openai.BadRequestError as e:
+            raise Exception(f"⚠️ _{localized_text('openai_invalid', bot_language)}._ ⚠️\n{str(e)}") from e
+
+        except Exception as e:
+            raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
+
+        answer = response.choices[0].message.content.strip()
+        self.inline_cache.set(key, answer, self.config.get('inline_cache_ttl_minutes', 60) * 60)
+        self.add_cost(chat_id, self.model_profile.cost(response.usage.prompt_tokens, response.usage.completion_tokens))
         return answer, response.usage.total_tokens
 
     async def get_chat_response_stream(self, chat_id: str, query: str):
@@ -263,17 +379,28 @@ class OpenAIHelper:
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used, or 'not_finished'
+        :return: The pieces of the answer as `TextDelta` events, then a `StreamEnd` event with the footer
+        and the number of tokens used, or a single `DirectResult` event
         """
+        cached_answer, embedding = await self.__semantic_lookup(chat_id, query)
+        if cached_answer is not None:
+            yield TextDelta(cached_answer)
+            yield StreamEnd('', 0)
+            return
+
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-            if is_direct_result(response):
-                yield response, '0'
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+        started = time.monotonic()
+        response, route, answered_by = await self.__common_get_chat_response(chat_id, query, stream=True)
+        if self.config['enable_functions'] and not self.__is_vision(chat_id):
+            response, plugins_used, usage, answered_by = await self.__handle_function_call(
+                chat_id, response, stream=True, started=started, model=route.model, answered_by=answered_by
+            )
+            if isinstance(response, DirectResult):
+                yield response
                 return
 
-        answer = ''
+        parts = []
         last_chunk = None
         async for chunk in response:
             last_chunk = chunk
@@ -281,89 +408,107 @@ class OpenAIHelper:
                 continue
             delta = chunk.choices[0].delta
             if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
+                parts.append(delta.content)
+                yield TextDelta(delta.content)
 
-        answer = answer.strip()
+        answer = ''.join(parts).strip()
         await self.__add_to_history(chat_id, role='assistant', content=answer)
+        if embedding is not None and not plugins_used and self.config['n_choices'] == 1:
+            self.semantic_cache.add(embedding, answer)
 
-        usage = last_chunk.usage
+        self.__add_usage(usage, last_chunk, answered_by)
+        total_tokens = usage['prompt_tokens'] + usage['completion_tokens']
 
+        footer = ''
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            # gpt 4o-mini
-            cost = (0.00000015 * usage.prompt_tokens) + (0.0000006 * usage.completion_tokens)
-
-            # gpt 4o
-            # cost = (0.000005 * usage.prompt_tokens) + (0.000015 * usage.completion_tokens)
-
-            self.add_cost(chat_id, cost)
+            self.add_cost(chat_id, usage['cost'])
             total_cost = self.get_cost(chat_id)
             price = f'¢{total_cost * 100:.2f}' if total_cost >= 1e-4 else ''
-            answer += f'\n\n---\nID: {chat_id[-2:]} {price}'
+            footer += f'\n\n---\nID: {chat_id[-2:]} {price}'
+            footer += self.__route_footer(route, answered_by)
 
             # bot_language = self.config['bot_language']
-            # answer += (
+            # footer += (
             #     "\n\n---\n"
-            #     f"ID: {chat_id[-2:]} 💰 {str(usage.total_tokens)} {localized_text('stats_tokens', bot_language)}"
-            #     f" ({str(usage.prompt_tokens)} {localized_text('prompt', bot_language)},"
-            #     f" {str(usage.completion_tokens)} {localized_text('completion', bot_language)})"
+            #     f"ID: {chat_id[-2:]} 💰 {str(total_tokens)} {localized_text('stats_tokens', bot_language)}"
+            #     f" ({str(usage['prompt_tokens'])} {localized_text('prompt', bot_language)},"
+            #     f" {str(usage['completion_tokens'])} {localized_text('completion', bot_language)})"
             # )
             if show_plugins_used:
-                answer += f"\n🔌 {', '.join(plugin_names)}"
+                footer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
-            answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+            footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+
+        yield StreamEnd(footer, total_tokens)
+
+    async def __semantic_lookup(self, chat_id: str, query: str):
+        """
+        Looks up the answer to the first query of a conversation in the semantic cache, adding both
+        to the history if found. Later queries are not looked up, as their answers depend on the history.
+        :param chat_id: The chat ID
+        :param query: The query
+        :return: The cached answer, None if not found, and the embedding of the query to cache its answer with,
+        None if the query is not cacheable
+        """
+        if self.semantic_cache is None:
+            return None, None
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None and (
+            len(conversation.messages) > 1
+            or conversation.vision
+            or conversation.messages[0].content != self.config['assistant_prompt']
+        ):
+            return None, None
 
-        yield answer, usage.total_tokens
+        try:
+            answer, embedding = await self.semantic_cache.lookup(query)
+        except Exception as e:
+            logging.warning(f'Could not look up the semantic cache: {e}')
+            return None, None
+
+        if answer is not None:
+            if conversation is None:
+                await self.reset_chat_history(chat_id)
+            await self.__add_to_history(chat_id, role='user', content=query)
+            await self.__add_to_history(chat_id, role='assistant', content=answer)
+        return answer, embedding
+
+    async def __embed(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds texts with the embedding model, for the semantic cache.
+        """
+        tokens = sum(len(self.model_profile.get_encoding().encode(text)) for text in texts)
+        response = await self.clients.request(
+            'embeddings.create', tokens, model=self.config.get('embedding_model', 'text-embedding-3-small'), input=texts
+        )
+        return [item.embedding for item in response.data]
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3),
-    )
     async def __common_get_chat_response(self, chat_id: str, query: str, stream=False):
         """
-        Request a response from the GPT model.
+        Request a response from the GPT model, or the model the router picks for the query.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :return: The response, still to be consumed if streamed, the routing decision, None for vision
+        conversations, and the model that answered, which may be a fallback one
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                await self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
+            conversation = self.conversations.get(chat_id) or await self.reset_chat_history(chat_id)
+            conversation.last_updated = datetime.datetime.now()
 
             await self.__add_to_history(chat_id, role='user', content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    await self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    await self.__add_to_history(chat_id, role='assistant', content=summary)
-                    await self.__add_to_history(chat_id, role='user', content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    # FIXME update in DB
-                    self.conversations[chat_id] = [self.conversations[chat_id][0]] + self.conversations[chat_id][
-                        -self.config['max_history_size'] - 1 :
-                    ]
+            route = None
+            if not conversation.vision:
+                route = self.router.route(chat_id, query, self.__conversation_token_count(conversation))
+            self.__use_model(conversation, route.model if route is not None else self.config['vision_model'])
+            conversation = await self.__fit_history(chat_id, conversation)
 
             common_args = {
-                'model': self.config['model']
-                if not self.conversations_vision[chat_id]
-                else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'model': route.model if route is not None else self.config['vision_model'],
+                'messages': [message.to_dict(self.blobs) for message in conversation.messages],
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 'max_tokens': self.config['max_tokens'],
@@ -374,15 +519,23 @@ class OpenAIHelper:
             if stream:
                 common_args['stream_options'] = {'include_usage': True}
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-                functions = self.plugin_manager.get_functions_specs()
-                if len(functions) > 0:
-                    common_args['functions'] = functions
-                    common_args['function_call'] = 'auto'
-            return await self.client.chat.completions.create(**common_args)
+            if self.config['enable_functions'] and route is not None and get_model_profile(route.model).functions:
+                tools = self.plugin_manager.get_tools_specs()
+                if len(tools) > 0:
+                    common_args['tools'] = tools
+                    common_args['tool_choice'] = 'auto'
+            tokens = self.__conversation_token_count(conversation) + common_args['max_tokens'] * common_args['n']
+            if conversation.vision:
+                response = await self.clients.request('chat.completions.create', tokens, chat_id, **common_args)
+                return response, None, common_args['model']
+            response, answered_by = await self.__create_chat_completion(chat_id, tokens, **common_args)
+            return response, route, answered_by
+
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(bot_language) from e
 
         except openai.RateLimitError as e:
-            raise e
+            raise Exception(f"⚠️ _{localized_text('openai_rate_limit', bot_language)}._ ⚠️\n{str(e)}") from e
 
         except openai.BadRequestError as e:
             raise Exception(f"⚠️ _{localized_text('openai_invalid', bot_language)}._ ⚠️\n{str(e)}") from e
@@ -390,65 +543,205 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
-        # FIXME misses correct count of tokens on chained function calls
-        function_name = ''
-        arguments = ''
-        if stream:
-            async for item in response:
-                if len(item.choices) > 0:
-                    first_choice = item.choices[0]
-                    if first_choice.delta and first_choice.delta.function_call:
-                        if first_choice.delta.function_call.name:
-                            function_name += first_choice.delta.function_call.name
-                        if first_choice.delta.function_call.arguments:
-                            arguments += first_choice.delta.function_call.arguments
-                    elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
-                        break
-                    else:
-                        return response, plugins_used
-                else:
-                    return response, plugins_used
-        else:
-            if len(response.choices) > 0:
-                first_choice = response.choices[0]
-                if first_choice.message.function_call:
-                    if first_choice.message.function_call.name:
-                        function_name += first_choice.message.function_call.name
-                    if first_choice.message.function_call.arguments:
-                        arguments += first_choice.message.function_call.arguments
+    async def __create_chat_completion(self, chat_id, tokens: int, **args):
+        """
+        Requests a chat completion, falling through the cascade of fallback models when a model fails.
+        If hedging is enabled and the first token takes longer than the 95th percentile of the recent ones,
+        a second request is sent to the next model of the cascade, or the same one if it is the last,
+        and the first one to start answering wins.
+        :param chat_id: The chat ID
+        :param tokens: The estimated number of tokens of the request, including the completion
+        :param args: The arguments of the request
+        :return: The response, whose first chunk is already received if streamed, and the model that answered
+        """
+        models = list(dict.fromkeys([args['model'], *self.config.get('fallback_models', [])]))
+        stream = args.get('stream', False)
+
+        async def attempt(model):
+            started = time.monotonic()
+            response = await self.clients.request(
+                'chat.completions.create', tokens, chat_id, **{**args, 'model': model}
+            )
+            if stream:
+                response = await _first_token(response)
+            self.latencies.record((model, stream), time.monotonic() - started)
+            return response
+
+        for i, model in enumerate(models):
+            try:
+                if not self.config.get('hedge_requests', False):
+                    return await attempt(model), model
+                hedge_model = models[i + 1] if i + 1 < len(models) else model
+                response, winner = await hedged(attempt, model, hedge_model, self.latencies.deadline((model, stream)))
+                if winner != model:
+                    logging.info(f'The hedged request to {winner} answered chat ID {chat_id} first')
+                return response, winner
+            except Exception as e:
+                if i + 1 == len(models):
+                    raise
+                logging.warning(f'Request to {model} failed ({e}), falling back to {models[i + 1]}')
+
+    async def __handle_function_call(self, chat_id, response, stream=False, started=None, model=None, answered_by=None):
+        """
+        Runs the tool calls requested by the model and sends their results back to it, in a loop,
+        until it answers or the maximum number of consecutive calls is reached.
+        :param chat_id: The chat ID
+        :param response: The response to the initial request
+        :param stream: Whether the responses are streamed
+        :param started: The monotonic time the initial request was sent at, to log the latency of each hop
+        :param model: The model answering the conversation, defaulting to the configured one
+        :param answered_by: The model that produced the response, which may be a fallback one
+        :return: The final response, still to be consumed if streamed, or a direct result, the names of the
+        plugins used, the usage of all completions before the final one, and the model that produced the final one
+        """
+        plugins_used = ()
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+        started = started or time.monotonic()
+        conversation = self.conversations.get(chat_id)
+        for times in range(self.config['functions_max_consecutive_calls'] + 1):
+            tool_calls, hop_completion, response = await self.__collect_tool_calls(response, stream)
+            if not tool_calls:
+                return response, plugins_used, usage, answered_by
+            self.__add_usage(usage, hop_completion, answered_by)
+            completed = time.monotonic()
+
+            await self.__add_tool_calls_to_history(chat_id, tool_calls)
+            function_responses = await asyncio.gather(*(self.__call_tool(tool_call) for tool_call in tool_calls))
+            logging.info(
+                f'Tool call hop {times + 1} for chat ID {chat_id}: completion took {completed - started:.2f}s, '
+                f'{len(tool_calls)} tool calls took {time.monotonic() - completed:.2f}s'
+            )
+
+            direct_result = None
+            for tool_call, function_response in zip(tool_calls, function_responses):
+                function_name = tool_call['function']['name']
+                if function_name not in plugins_used:
+                    plugins_used += (function_name,)
+
+                result = DirectResult.from_plugin_response(function_response)
+                if result is None:
+                    content = json.dumps(function_response, default=str)
+                elif direct_result is None:
+                    direct_result = result
+                    content = json.dumps({'result': 'Done, the content has been sent to the user.'})
                 else:
-                    return response, plugins_used
-            else:
-                return response, plugins_used
+                    content = json.dumps({'error': 'Only one result can be sent to the user at a time.'})
+                await self.__add_tool_result_to_history(chat_id, tool_call, content)
 
-        logging.info(f'Calling function {function_name} with arguments {arguments}')
-        function_response = await self.plugin_manager.call_function(function_name, self, arguments)
+            if direct_result is not None:
+                direct_result.tokens = usage['prompt_tokens'] + usage['completion_tokens']
+                return direct_result, plugins_used, usage, answered_by
 
-        if function_name not in plugins_used:
-            plugins_used += (function_name,)
+            # The conversation may have been evicted or reset while the tools were running,
+            # losing the tool calls and results the follow-up request needs
+            if conversation is None or self.conversations.get(chat_id) is not conversation:
+                bot_language = self.config['bot_language']
+                raise Exception(
+                    f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n"
+                    'The conversation was reset while the plugins were running'
+                )
 
-        if is_direct_result(function_response):
-            await self.__add_function_call_to_history(
-                chat_id=chat_id,
-                function_name=function_name,
-                content=json.dumps({'result': 'Done, the content has been sent' 'to the user.'}),
-            )
-            return function_response, plugins_used
+            started = time.monotonic()
+            args = {
+                'model': model or self.config['model'],
+                'messages': [message.to_dict(self.blobs) for message in conversation.messages],
+                'tools': self.plugin_manager.get_tools_specs(),
+                'tool_choice': 'auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
+                'stream': stream,
+            }
+            if stream:
+                args['stream_options'] = {'include_usage': True}
+            tokens = self.__conversation_token_count(conversation) + self.config['max_tokens']
+            response, answered_by = await self.__create_chat_completion(chat_id, tokens, **args)
+        return response, plugins_used, usage, answered_by
 
-        json_func_response = json.dumps(function_response, default=str)
-        await self.__add_function_call_to_history(
-            chat_id=chat_id, function_name=function_name, content=json_func_response
-        )
-        response = await self.client.chat.completions.create(
-            model=self.config['model'],
-            messages=self.conversations[chat_id],
-            functions=self.plugin_manager.get_functions_specs(),
-            function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
-            stream=stream,
-            stream_options={'include_usage': True},
-        )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+    @staticmethod
+    async def __collect_tool_calls(response, stream):
+        """
+        Collects the tool calls requested by a response.
+        :param response: The response
+        :param stream: Whether the response is streamed
+        :return: The tool calls in the OpenAI wire format, empty if the model answered, the response or chunk
+        carrying its usage if it requested tool calls, and the response with its already consumed chunks if it did not
+        """
+        if not stream:
+            if len(response.choices) == 0 or not response.choices[0].message.tool_calls:
+                return [], None, response
+            tool_calls = [
+                {
+                    'id': tool_call.id,
+                    'type': 'function',
+                    'function': {'name': tool_call.function.name, 'arguments': tool_call.function.arguments},
+                }
+                for tool_call in response.choices[0].message.tool_calls
+            ]
+            return tool_calls, response, response
+
+        tool_calls = {}  # by index, as the deltas of parallel tool calls are interleaved
+        usage_chunk = None
+        async for item in response:
+            if item.usage:
+                usage_chunk = item
+            if len(item.choices) == 0:
+                continue
+            first_choice = item.choices[0]
+            if first_choice.delta and first_choice.delta.tool_calls:
+                for tool_call in first_choice.delta.tool_calls:
+                    call = tool_calls.setdefault(
+                        tool_call.index,
+                        {'id': '', 'type': 'function', 'function': {'name': '', 'arguments': ''}},
+                    )
+                    if tool_call.id:
+                        call['id'] += tool_call.id
+                    if tool_call.function and tool_call.function.name:
+                        call['function']['name'] += tool_call.function.name
+                    if tool_call.function and tool_call.function.arguments:
+                        call['function']['arguments'] += tool_call.function.arguments
+            elif not tool_calls and not first_choice.finish_reason:
+                # The model answers, give back the chunk consumed to find out, before the rest of the same stream
+                return [], None, _prepend([item], response)
+        return [tool_calls[index] for index in sorted(tool_calls)], usage_chunk, response
+
+    @staticmethod
+    def __add_usage(usage: dict, completion, model: str) -> None:
+        """
+        Adds the usage of a completion, or of the streamed chunk carrying it, to the given totals.
+        :param usage: The totals
+        :param completion: The completion or chunk, None if the usage is unknown
+        :param model: The model that answered, which may be a fallback one, to price the usage with
+        """
+        if completion is not None and completion.usage is not None:
+            prompt_tokens, completion_tokens = completion.usage.prompt_tokens, completion.usage.completion_tokens
+            usage['prompt_tokens'] += prompt_tokens
+            usage['completion_tokens'] += completion_tokens
+            usage['cost'] += get_model_profile(model).cost(prompt_tokens, completion_tokens)
+
+    def __route_footer(self, route, answered_by: str) -> str:
+        """
+        Describes the model that answered and why for the usage footer, if routing or a fallback model chose it.
+        :param route: The routing decision, None for vision conversations
+        :param answered_by: The model that answered
+        """
+        if route is None or (not self.router.rules and answered_by == route.model):
+            return ''
+        if answered_by != route.model:
+            return f'\n🧭 {answered_by} ({route.reason}, fallback for {route.model})'
+        return f'\n🧭 {route.model} ({route.reason})'
+
+    async def __call_tool(self, tool_call) -> dict:
+        """
+        Calls the plugin function requested by a tool call.
+        :param tool_call: The tool call, in the OpenAI wire format
+        :return: The function response, or an error to report to the model if the call failed
+        """
+        function_name = tool_call['function']['name']
+        arguments = tool_call['function']['arguments']
+        logging.info(f'Calling function {function_name} with arguments {arguments}')
+        try:
+            return await self.plugin_manager.call_function(function_name, self, arguments)
+        except Exception as e:
+            logging.exception(f'Function {function_name} failed: {e}')
+            return {'error': str(e)}
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -458,7 +751,8 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.images.generate(
+            response = await self.clients.request(
+                'images.generate',
                 prompt=prompt,
                 n=1,
                 model=self.config['image_model'],
@@ -474,6 +768,8 @@ class OpenAIHelper:
                 )
 
             return response.data[0].url, self.config['image_size']
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(bot_language) from e
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
@@ -485,7 +781,8 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.audio.speech.create(
+            response = await self.clients.request(
+                'audio.speech.create',
                 model=self.config['tts_model'],
                 voice=self.config['tts_voice'],
                 input=text,
@@ -496,6 +793,8 @@ class OpenAIHelper:
             temp_file.write(response.read())
             temp_file.seek(0)
             return temp_file, len(text)
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(bot_language) from e
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
@@ -506,74 +805,52 @@ class OpenAIHelper:
         """
         try:
             with open(filename, 'rb') as audio:  # noqa: ASYNC101
-                prompt_text = self.config['whisper_prompt']
-                result = await self.client.audio.transcriptions.create(
-                    model='whisper-1', file=audio, prompt=prompt_text
-                )
-                return result.text
+                # Read once, so that retries send the whole file again
+                file = (os.path.basename(filename), audio.read())
+            prompt_text = self.config['whisper_prompt']
+            result = await self.clients.request(
+                'audio.transcriptions.create', model='whisper-1', file=file, prompt=prompt_text
+            )
+            return result.text
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(self.config['bot_language']) from e
         except Exception as e:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3),
-    )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    @staticmethod
+    def __unavailable_error(bot_language: str) -> Exception:
+        """
+        The error reported while the circuit breaker fails requests fast.
+        """
+        return Exception(
+            f"⚠️ _{localized_text('openai_unavailable', bot_language)}._ ⚠️\n{localized_text('try_again', bot_language)}."
+        )
+
+    async def __common_get_chat_response_vision(self, chat_id: int, message: Message, stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
-        :param query: The query to send to the model
+        :param message: The user message with the text and image to send to the model
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                await self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
+            conversation = self.conversations.get(chat_id) or await self.reset_chat_history(chat_id)
+            conversation.last_updated = datetime.datetime.now()
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
-                await self.__add_to_history(chat_id, role='user', content=content)
-            else:
-                query = None
-
-                for message in content:
-                    if message['type'] == 'text':
-                        query = message['text']
-                        break
-
-                if query:
-                    await self.__add_to_history(chat_id, role='user', content=query)
-
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    await self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    await self.__add_to_history(chat_id, role='assistant', content=summary)
-                    await self.__add_to_history(chat_id, role=last['role'], content=last['content'])
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = [self.conversations[chat_id][0]] + self.conversations[chat_id][
-                        -self.config['max_history_size'] - 1 :
-                    ]
-
-            message = {'role': 'user', 'content': content}
+                conversation.vision = True
+                await self.__add_message_to_history(chat_id, message)
+            elif message.content:
+                await self.__add_to_history(chat_id, role='user', content=message.content)
+
+            self.__use_model(conversation, self.config['vision_model'])
+            conversation = await self.__fit_history(chat_id, conversation)
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': [m.to_dict(self.blobs) for m in conversation.messages[:-1]] + [message.to_dict(self.blobs)],
                 'temperature': self.config['temperature'],
                 'n': 1,  # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -593,10 +870,15 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
 
-            return await self.client.chat.completions.create(**common_args)
+            messages = conversation.messages[:-1] + [message]
+            tokens = self.__count_tokens(messages, self.vision_model_profile) + common_args['max_tokens']
+            return await self.clients.request('chat.completions.create', tokens, chat_id, **common_args)
+
+        except CircuitOpenError as e:
+            raise self.__unavailable_error(bot_language) from e
 
         except openai.RateLimitError as e:
-            raise e
+            raise Exception(f"⚠️ _{localized_text('openai_rate_limit', bot_language)}._ ⚠️\n{str(e)}") from e
 
         except openai.BadRequestError as e:
             raise Exception(f"⚠️ _{localized_text('openai_invalid', bot_language)}._ ⚠️\n{str(e)}") from e
@@ -604,28 +886,18 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def interpret_image(self, chat_id, fileobj, prompt=None):
+    async def interpret_image(self, chat_id, fileobj, prompt=None, image_id=None):
         """
         Interprets a given PNG image file using the Vision model.
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
-
-        content = [
-            {'type': 'text', 'text': prompt},
-            {
-                'type': 'image_url',
-                'image_url': {'url': image, 'detail': self.config['vision_detail']},
-            },
-        ]
-
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        message = self.__vision_message(fileobj, prompt, image_id)
+        response = await self.__common_get_chat_response_vision(chat_id, message)
 
         # functions are not available for this model
 
         # if self.config['enable_functions']:
         #     response, plugins_used = await self.__handle_function_call(chat_id, response)
-        #     if is_direct_result(response):
+        #     if isinstance(response, DirectResult):
         #         return response, '0'
 
         answer = ''
@@ -660,30 +932,20 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
-    async def interpret_image_stream(self, chat_id, fileobj, prompt=None):
+    async def interpret_image_stream(self, chat_id, fileobj, prompt=None, image_id=None):
         """
         Interprets a given PNG image file using the Vision model.
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
-
-        content = [
-            {'type': 'text', 'text': prompt},
-            {
-                'type': 'image_url',
-                'image_url': {'url': image, 'detail': self.config['vision_detail']},
-            },
-        ]
-
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        message = self.__vision_message(fileobj, prompt, image_id)
+        response = await self.__common_get_chat_response_vision(chat_id, message, stream=True)
 
         # if self.config['enable_functions']:
         #     response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-        #     if is_direct_result(response):
-        #         yield response, '0'
+        #     if isinstance(response, DirectResult):
+        #         yield response
         #         return
 
-        answer = ''
+        parts = []
         last_chunk = None
         async for chunk in response:
             last_chunk = chunk
@@ -691,29 +953,41 @@ class OpenAIHelper:
                 continue
             delta = chunk.choices[0].delta
             if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
+                parts.append(delta.content)
+                yield TextDelta(delta.content)
 
         usage = last_chunk.usage
-        answer = answer.strip()
+        answer = ''.join(parts).strip()
         await self.__add_to_history(chat_id, role='assistant', content=answer)
-        # tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
         tokens_used = usage.total_tokens
 
-        # gpt 4o-mini
-        cost = (0.00000015 * usage.prompt_tokens) + (0.0000006 * usage.completion_tokens)
+        cost = self.vision_model_profile.cost(usage.prompt_tokens, usage.completion_tokens)
         price = f'¢{cost * 100:.2f}' if cost >= 1e-4 else ''
 
+        footer = ''
         # show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         # plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            answer += f'\n\n---\nID: {chat_id[-2:]} {price}'
+            footer += f'\n\n---\nID: {chat_id[-2:]} {price}'
         #     if show_plugins_used:
-        #         answer += f"\n🔌 {', '.join(plugin_names)}"
+        #         footer += f"\n🔌 {', '.join(plugin_names)}"
         # elif show_plugins_used:
-        #     answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+        #     footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        yield StreamEnd(footer, tokens_used)
+
+    def __vision_message(self, fileobj, prompt=None, image_id=None) -> Message:
+        """
+        Builds the user message of a vision request, storing its image once and counting its tokens once.
+        :param fileobj: The PNG image file
+        :param prompt: The prompt, defaults to the configured vision prompt
+        :param image_id: A stable identifier of the image, e.g. its Telegram file_unique_id
+        :return: The message, referencing the image in the blob store
+        """
+        prompt = self.config['vision_prompt'] if prompt is None else prompt
+        key = self.blobs.put(fileobj.getvalue(), image_id)
+        image_tokens = self.__count_tokens_vision(fileobj)
+        return Message('user', prompt, image=(key, self.config['vision_detail']), image_tokens=image_tokens)
 
     async def reset_chat_history(self, chat_id, content=''):
         """
@@ -721,32 +995,26 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{'role': 'system', 'content': content}]
-        self.conversations_vision[chat_id] = False
-        self.conversations_costs[chat_id] = 0
+        conversation = self.conversations.create(chat_id)
+        # Share a single copy of the system prompt between all conversations using it
+        self.__append_to_history(chat_id, Message('system', sys.intern(content)))
 
         await self.init_conv_in_db(chat_id)
         await self.add_conv_in_db(chat_id, 'system', content)
+        return conversation
 
-    def __max_age_reached(self, chat_id) -> bool:
+    async def __add_tool_calls_to_history(self, chat_id, tool_calls):
         """
-        Checks if the maximum conversation age has been reached.
-        :param chat_id: The chat ID
-        :return: A boolean indicating whether the maximum conversation age has been reached
+        Adds the tool calls requested by the assistant to the conversation history
         """
-        if chat_id not in self.last_updated:
-            return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
-        max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        await self.__add_message_to_history(chat_id, Message('assistant', '', tool_calls=tool_calls))
 
-    async def __add_function_call_to_history(self, chat_id, function_name, content):
+    async def __add_tool_result_to_history(self, chat_id, tool_call, content):
         """
-        Adds a function call to the conversation history
+        Adds the result of a tool call to the conversation history
         """
-        self.conversations[chat_id].append({'role': 'function', 'name': function_name, 'content': content})
-        await self.add_conv_in_db(chat_id, 'function', content, function_name)
+        message = Message('tool', content, name=tool_call['function']['name'], tool_call_id=tool_call['id'])
+        await self.__add_message_to_history(chat_id, message)
 
     async def __add_to_history(self, chat_id, role, content):
         """
@@ -755,27 +1023,240 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({'role': role, 'content': content})
+        await self.__add_message_to_history(chat_id, Message(role, content))
+
+    async def __add_message_to_history(self, chat_id, message):
+        """
+        Adds a message to the conversation history. Images are stored in the database by reference only.
+        :param chat_id: The chat ID
+        :param message: The message to add
+        """
+        self.__append_to_history(chat_id, message)
+        await self.add_conv_in_db(chat_id, message.role, self.__db_content(message), message.name)
+        if message.role == 'assistant' and message.tool_calls is None:
+            self.__schedule_summary(chat_id)
+
+    @staticmethod
+    def __db_content(message) -> str:
+        """
+        Gets the content of a message as stored in the database, with images stored by reference only.
+        """
+        if message.tool_calls is not None:
+            return json.dumps({'content': message.content, 'tool_calls': message.tool_calls})
+        if message.image is None:
+            return message.content
+        key, detail = message.image
+        return json.dumps(
+            [
+                {'type': 'text', 'text': message.content},
+                {'type': 'image_url', 'image_url': {'url': f'blob:{key}', 'detail': detail}},
+            ]
+        )
+
+    async def __rewrite_history_in_db(self, chat_id, messages):
+        """
+        Replaces the persisted history of a conversation, e.g. after it was compacted.
+        :param chat_id: The chat ID
+        :param messages: The new messages
+        """
+        await self.init_conv_in_db(chat_id)
+        for message in messages:
+            await self.add_conv_in_db(chat_id, message.role, self.__db_content(message), message.name)
+
+    def __schedule_summary(self, chat_id):
+        """
+        Starts summarising the conversation in the background once it reaches the configured fraction
+        of the token or history size limit, so that foreground requests rarely have to wait for it.
+        :param chat_id: The chat ID
+        """
+        threshold = self.config.get('summarise_threshold', 0)
+        if not threshold or self.config.get('context_strategy', 'summarise') != 'summarise':
+            return
+        conversation = self.conversations.get(chat_id)
+        if conversation is None or chat_id in self.summarising:
+            return
+        token_limit = self.__conversation_profile(conversation).context_window - self.config['max_tokens']
+        near_max_tokens = self.__conversation_token_count(conversation) >= threshold * token_limit
+        near_max_history_size = len(conversation.messages) >= threshold * self.config['max_history_size']
+        if not (near_max_tokens or near_max_history_size):
+            return
+        task = asyncio.create_task(self.__summarise_in_background(chat_id, conversation, list(conversation.messages)))
+        self.summarising[chat_id] = task
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def __summarise_in_background(self, chat_id, conversation, snapshot):
+        """
+        Replaces all but the last exchange of the conversation with a summary. Messages added while the
+        summary is generated are kept, and the history is only swapped if it was not reset in the meantime.
+        :param chat_id: The chat ID
+        :param conversation: The conversation
+        :param snapshot: The messages of the conversation when the summary was scheduled
+        """
+        try:
+            split = len(snapshot) - 2  # the last question and answer are kept verbatim
+            while split > 1 and snapshot[split].role == 'tool':
+                split -= 1  # along with the tool calls they answer
+            if split <= 1:
+                return
+            logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+            summary = await self.__summarise(snapshot[1:split])
+            logging.debug(f'Summary: {summary}')
+
+            # No await between the check and the swap, so no request can interleave with them
+            current = conversation.messages
+            if (
+                self.conversations.get(chat_id) is not conversation
+                or len(current) < len(snapshot)
+                or any(a is not b for a, b in zip(current, snapshot))
+            ):
+                logging.info(f'Chat history for chat ID {chat_id} changed while summarising, discarding summary')
+                return
+            summary_message = Message('assistant', summary, pinned=True)
+            summary_message.tokens = self.__count_message_tokens(
+                summary_message, self.__conversation_profile(conversation)
+            )
+            messages = [snapshot[0], summary_message] + current[split:]
+            self.conversations.replace(conversation, messages)
+            await self.__rewrite_history_in_db(chat_id, messages)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history in the background: {str(e)}')
+        finally:
+            self.summarising.pop(chat_id, None)
+
+    def __append_to_history(self, chat_id, message):
+        """
+        Appends a message to the in-memory history, counting its tokens once.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        """
+        conversation = self.conversations.get(chat_id)
+        if conversation is None:
+            logging.warning(f'Conversation {chat_id} was evicted, not adding message to its history')
+            return
+        message.tokens = self.__count_message_tokens(message, self.__conversation_profile(conversation))
+        self.conversations.append(conversation, message)
+
+    def __use_model(self, conversation, model: Optional[str]) -> None:
+        """
+        Sets the model answering a conversation, whose profile sizes its history, recounting the tokens of
+        the history if the model counts them differently from the previous one.
+        :param conversation: The conversation
+        :param model: The model, None for the configured one
+        """
+        previous = self.__conversation_profile(conversation)
+        conversation.model = model
+        profile = self.__conversation_profile(conversation)
+        counting = (profile.encoding_name, profile.tokens_per_message, profile.tokens_per_name)
+        if counting == (previous.encoding_name, previous.tokens_per_message, previous.tokens_per_name):
+            return
+        for message in conversation.messages:
+            message.tokens = self.__count_message_tokens(message, profile)
+        self.conversations.replace(conversation, conversation.messages)
+
+    def __conversation_profile(self, conversation):
+        """
+        Gets the profile of the model answering a conversation.
+        """
+        return get_model_profile(conversation.model) if conversation.model else self.model_profile
+
+    async def __fit_history(self, chat_id, conversation):
+        """
+        Summarises or truncates the history, depending on the context strategy, if it exceeds
+        the token or history size limit. Summarising falls back to truncating if it fails.
+        If the conversation is already being summarised in the background, that summary is waited for
+        instead of paying for a second one, and the history is truncated if it still exceeds the limits.
+        :param chat_id: The chat ID
+        :param conversation: The conversation, ending with the message to answer
+        :return: The conversation, which is replaced when summarised
+        """
+        if not self.__exceeds_limits(conversation):
+            return conversation
+
+        background_summary = self.summarising.get(chat_id)
+        if background_summary is not None:
+            logging.info(f'Chat history for chat ID {chat_id} is too long. Waiting for its summary...')
+            await asyncio.shield(background_summary)  # not cancelled along with the request
+            if not self.__exceeds_limits(conversation):
+                return conversation
+            logging.info(f'Chat history for chat ID {chat_id} is still too long. Truncating...')
+        elif self.config.get('context_strategy', 'summarise') == 'summarise':
+            logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
+            try:
+                last = conversation.messages[-1]
+                summary = await self.__summarise(conversation.messages[:-1])
+                logging.debug(f'Summary: {summary}')
+                vision, cost, model = conversation.vision, conversation.cost, conversation.model
+                conversation = await self.reset_chat_history(chat_id, conversation.messages[0].content)
+                self.__use_model(conversation, model)
+                conversation.vision, conversation.cost = vision, cost
+                await self.__add_message_to_history(chat_id, Message('assistant', summary, pinned=True))
+                await self.__add_message_to_history(chat_id, last)
+                return conversation
+            except Exception as e:
+                logging.warning(f'Error while summarising chat history: {str(e)}. Truncating it instead...')
+        else:
+            logging.info(f'Chat history for chat ID {chat_id} is too long. Truncating...')
 
-        data = await async_maybe_transform({'message': {'role': role, 'content': content}}, self.MessageDb)
-        msg = data['message']
+        await self.__truncate_history(chat_id, conversation)
+        return conversation
+
+    def __exceeds_limits(self, conversation) -> bool:
+        """
+        Whether the conversation exceeds the token or history size limit.
+        """
+        token_count = self.__conversation_token_count(conversation)
+        exceeded_max_tokens = (
+            token_count + self.config['max_tokens'] > self.__conversation_profile(conversation).context_window
+        )
+        exceeded_max_history_size = len(conversation.messages) > self.config['max_history_size']
+        return exceeded_max_tokens or exceeded_max_history_size
 
-        if not isinstance(msg['content'], str):
-            msg['content'] = json.dumps(msg['content'])
+    async def __truncate_history(self, chat_id, conversation):
+        """
+        Keeps the system message, the pinned summary and the most recent messages that fit into
+        the token and history size limits, in memory and in the database.
+        The history is cut to 3/4 of the limits, so that it is not rewritten again on the next messages.
+        :param chat_id: The chat ID
+        :param conversation: The conversation
+        """
+        max_tokens = self.__conversation_profile(conversation).context_window - self.config['max_tokens'] - 3
+        max_messages = max(self.config['max_history_size'] * 3 // 4, 1)
+        dropped = self.conversations.truncate(conversation, max_tokens * 3 // 4, max_messages)
+        if dropped:
+            logging.debug(f'Dropped {dropped} messages from chat ID {chat_id}')
+            await self.__rewrite_history_in_db(chat_id, conversation.messages)
+
+    @staticmethod
+    def __conversation_token_count(conversation) -> int:
+        """
+        Gets the number of tokens required to send the conversation history, without re-encoding it.
+        :param conversation: The conversation
+        :return: the number of tokens required
+        """
+        return conversation.token_count + 3  # every reply is primed with <|start|>assistant<|message|>
 
-        await self.add_conv_in_db(chat_id, msg['role'], msg['content'])
+    def __is_vision(self, chat_id) -> bool:
+        """
+        Whether the conversation is answered by the vision model.
+        """
+        conversation = self.conversations.get(chat_id)
+        return conversation is not None and conversation.vision
 
     def add_cost(self, chat_id, cost):
         """
         Adds the cost to the conversation.
         """
-        self.conversations_costs[chat_id] = cost + self.conversations_costs.get(chat_id, 0)
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None:
+            conversation.cost += cost
 
     def get_cost(self, chat_id):
         """
         Gets the cost of the conversation.
         """
-        return self.conversations_costs.get(chat_id, 0)
+        conversation = self.conversations.get(chat_id)
+        return conversation.cost if conversation is not None else 0
 
     async def __summarise(self, conversation) -> str:
         """
@@ -783,90 +1264,70 @@ class OpenAIHelper:
         :param conversation: The conversation history
         :return: The summary
         """
+        model = self.config.get('summary_model') or self.config['model']
+        encoding = get_model_profile(model).get_encoding()
         messages = [
             {
                 'role': 'assistant',
                 'content': 'Summarize this conversation in 700 characters or less',
             },
-            {'role': 'user', 'content': str(conversation)},
+            {
+                'role': 'user',
+                'content': render_transcript(conversation, encoding, self.config['summary_max_input_tokens']),
+            },
         ]
-        response = await self.client.chat.completions.create(
-            model=self.config['model'], messages=messages, temperature=0.4
+        tokens = sum(len(encoding.encode(message['content'])) for message in messages) + 700  # less than 700 chars
+        response = await self.clients.request(
+            'chat.completions.create', tokens, model=model, messages=messages, temperature=0.4
         )
         return response.choices[0].message.content
 
-    def __max_model_tokens(self):
-        base = 4096
-        if self.config['model'] in GPT_3_MODELS:
-            return base
-        if self.config['model'] in GPT_3_16K_MODELS:
-            return base * 4
-        if self.config['model'] in GPT_4_MODELS:
-            return base * 2
-        if self.config['model'] in GPT_4_32K_MODELS:
-            return base * 8
-        if self.config['model'] in GPT_4_VISION_MODELS:
-            return base * 31
-        if self.config['model'] in GPT_4_128K_MODELS:
-            return base * 31
-        if self.config['model'] in GPT_4O_MODELS:
-            return base * 4
-        raise NotImplementedError(f"Max tokens for model {self.config['model']} is not implemented yet.")
-
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_tokens(self, messages: list[Message], profile=None) -> int:
         """
         Counts the number of tokens required to send the given messages.
         :param messages: the messages to send
+        :param profile: the profile of the model to count for, defaulting to the configured model
         :return: the number of tokens required
         """
-        model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding('gpt-3.5-turbo')
-
-        if model in GPT_3_MODELS + GPT_3_16K_MODELS:
-            tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-            tokens_per_name = -1  # if there's a name, the role is omitted
-        elif model in GPT_4_MODELS + GPT_4_32K_MODELS + GPT_4_VISION_MODELS + GPT_4_128K_MODELS + GPT_4O_MODELS:
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
-            raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
-                    num_tokens += len(encoding.encode(value))
-                    if key == 'name':
-                        num_tokens += tokens_per_name
+        num_tokens = sum(self.__count_message_tokens(message, profile) for message in messages)
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
+    def __count_message_tokens(self, message: Message, profile=None) -> int:
+        """
+        Counts the number of tokens a single history entry adds to a request.
+        :param message: the message to count
+        :param profile: the profile of the model to count for, defaulting to the configured model
+        :return: the number of tokens required
+        """
+        profile = profile or self.model_profile
+        encoding = profile.get_encoding()
+        num_tokens = profile.tokens_per_message
+        num_tokens += len(encoding.encode(message.role))
+        num_tokens += len(encoding.encode(message.content))
+        if message.name is not None and message.tool_call_id is None:
+            num_tokens += len(encoding.encode(message.name)) + profile.tokens_per_name
+        if message.tool_call_id is not None:
+            num_tokens += len(encoding.encode(message.tool_call_id))
+        for tool_call in message.tool_calls or ():
+            num_tokens += len(encoding.encode(tool_call['function']['name']))
+            num_tokens += len(encoding.encode(tool_call['function']['arguments']))
+        num_tokens += message.image_tokens
+        return num_tokens
+
     # no longer needed
 
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, fileobj) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param fileobj: image file to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
+        fileobj.seek(0)
+        image = Image.open(fileobj)  # only reads the header
         model = self.config['vision_model']
-        if model not in GPT_4_VISION_MODELS:
+        if not self.vision_model_profile.vision:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
 
         w, h = image.size
@@ -1,6 +1,7 @@
 import json
 from typing import Dict
 
+from cache import SingleFlight, TTLCache
 from plugins.auto_tts import AutoTextToSpeech
 from plugins.ddg_image_search import DDGImageSearchPlugin
 from plugins.dice import DicePlugin
@@ -48,6 +49,8 @@ class PluginManager:
             enabled_plugins = list(plugin_mapping.keys())
 
         self.plugins = [plugin_mapping[plugin]() for plugin in enabled_plugins if plugin in plugin_mapping]
+        self.cache = TTLCache(config.get('plugin_cache_size', 0))
+        self.in_flight = SingleFlight()
 
     def get_functions_specs(self):
         """
@@ -55,15 +58,41 @@ class PluginManager:
         """
         return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
 
+    def get_tools_specs(self):
+        """
+        Return the list of tool specs that can be called by the model
+        """
+        return [{'type': 'function', 'function': spec} for spec in self.get_functions_specs()]
+
     async def call_function(self, function_name, helper, arguments) -> Dict:
         """
-        Call a function based on the name and parameters provided
+        Call a function based on the name and parameters provided.
+        Results are cached for the time to live declared by the plugin, by function name and arguments,
+        and concurrent calls of such functions with the same arguments share a single execution.
         """
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return {'error': f'Function {function_name} not found'}
 
-        return await plugin.execute(function_name, helper, **json.loads(arguments))
+        kwargs = json.loads(arguments)
+        ttl = plugin.get_cache_ttl(function_name)
+        if not ttl:
+            return await plugin.execute(function_name, helper, **kwargs)
+
+        key = (function_name, json.dumps(kwargs, sort_keys=True, separators=(',', ':')))
+        response = self.cache.get(key) if self.cache.max_size else None
+        if response is None:
+            response = await self.in_flight.do(key, lambda: self.__execute(plugin, helper, key, kwargs, ttl))
+        return response
+
+    async def __execute(self, plugin, helper, key, kwargs, ttl) -> Dict:
+        """
+        Execute a function and cache its response
+        """
+        response = await plugin.execute(key[0], helper, **kwargs)
+        if self.__is_cacheable(response):
+            self.cache.set(key, response, ttl)
+        return response
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -74,6 +103,15 @@ class PluginManager:
             return ''
         return plugin.get_source_name()
 
+    @staticmethod
+    def __is_cacheable(response) -> bool:
+        """
+        Whether a function response can be cached, i.e. it is neither an error nor a direct result
+        """
+        if not isinstance(response, dict):
+            return False
+        return not any(key.lower() in ('error', 'direct_result') for key in response)
+
     def __get_plugin_by_function_name(self, function_name):
         return next(
             (
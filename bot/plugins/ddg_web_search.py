@@ -18,6 +18,9 @@ class DDGWebSearchPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'DuckDuckGo'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600
+
     def get_spec(self) -> [Dict]:
         return [
             {
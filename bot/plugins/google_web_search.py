@@ -18,6 +18,9 @@ class GoogleWebSearchPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'Google'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600
+
     def get_spec(self) -> [Dict]:
         return [
             {
@@ -1,7 +1,5 @@
 from typing import Dict
 
-import httpx
-
 from .plugin import Plugin
 
 
@@ -13,6 +11,9 @@ class IpLocationPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'IP.FM'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 86400
+
     def get_spec(self) -> [Dict]:
         return [
             {
@@ -34,8 +35,7 @@ class IpLocationPlugin(Plugin):
 
             url = f'https://api.ip.fm/?ip={ip}'
 
-            async with httpx.AsyncClient() as client:
-                response = (await client.get(url)).json()
+            response = (await helper.http_clients.get().get(url)).json()
 
             country = response.get('data', {}).get('country', 'None')
             subdivisions = response.get('data', {}).get('subdivisions', 'None')
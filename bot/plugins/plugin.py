@@ -22,6 +22,13 @@ class Plugin(ABC):
         """
         pass
 
+    def get_cache_ttl(self, function_name) -> int:
+        """
+        Return the number of seconds the results of the given function can be cached for.
+        Defaults to 0, i.e. not cached, which must be kept for functions with side effects.
+        """
+        return 0
+
     @abstractmethod
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         """
@@ -34,6 +34,9 @@ class SpotifyPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'Spotify'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600 if function_name == 'spotify_search_by_query' else 0
+
     def get_spec(self) -> [Dict]:
         # time_range_param = {
         #     'type': 'string',
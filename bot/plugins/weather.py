@@ -1,8 +1,6 @@
 from datetime import datetime
 from typing import Dict
 
-import httpx
-
 from .plugin import Plugin
 
 
@@ -14,6 +12,9 @@ class WeatherPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'OpenMeteo'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 600
+
     def get_spec(self) -> [Dict]:
         latitude_param = {'type': 'string', 'description': 'Latitude of the location'}
         longitude_param = {'type': 'string', 'description': 'Longitude of the location'}
@@ -67,16 +68,14 @@ class WeatherPlugin(Plugin):
             )
             if function_name == 'get_current_weather':
                 url += '&current_weather=true'
-                async with httpx.AsyncClient() as client:
-                    return (await client.get(url)).json()
+                return (await helper.http_clients.get().get(url)).json()
 
             elif function_name == 'get_forecast_weather':
                 url += '&daily=weathercode,temperature_2m_max,temperature_2m_min,precipitation_probability_mean,'
                 url += f'&forecast_days={kwargs["forecast_days"]}'
                 url += '&timezone=auto'
 
-                async with httpx.AsyncClient() as client:
-                    response = (await client.get(url)).json()
+                response = (await helper.http_clients.get().get(url)).json()
 
                 results = {}
                 for i, time in enumerate(response['daily']['time']):
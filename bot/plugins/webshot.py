@@ -2,8 +2,6 @@ import random
 import string
 from typing import Dict
 
-import httpx
-
 from .plugin import Plugin
 
 
@@ -41,11 +39,11 @@ class WebshotPlugin(Plugin):
         try:
             image_url = f'https://image.thum.io/get/maxAge/12/width/720/{kwargs["url"]}'
 
-            async with httpx.AsyncClient() as client:
-                await client.get(image_url)
+            client = helper.http_clients.get()
+            await client.get(image_url)
 
-                # download the actual image
-                response = await client.get(image_url, timeout=30)
+            # download the actual image
+            response = await client.get(image_url, timeout=30)
 
             if response.status_code == 200:
                 return {
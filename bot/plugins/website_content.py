@@ -1,6 +1,5 @@
 from typing import Dict
 
-import httpx
 import readability
 
 from .plugin import Plugin
@@ -14,6 +13,9 @@ class WebsiteContentPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'Website Content'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 900
+
     def get_spec(self) -> [Dict]:
         return [
             {
@@ -33,8 +35,7 @@ class WebsiteContentPlugin(Plugin):
             if not url:
                 return {'result': 'URL not provided'}
 
-            async with httpx.AsyncClient() as client:
-                response = (await client.get(url)).content
+            response = (await helper.http_clients.get().get(url)).content
 
             doc = readability.Document(response)
 
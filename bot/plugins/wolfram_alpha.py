@@ -20,6 +20,9 @@ class WolframAlphaPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'WolframAlpha'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 600
+
     def get_spec(self) -> [Dict]:
         return [
             {
@@ -2,8 +2,6 @@ import os
 from datetime import datetime
 from typing import Dict
 
-import httpx
-
 from .plugin import Plugin
 
 
@@ -45,9 +43,8 @@ class WorldTimeApiPlugin(Plugin):
         url = f'https://worldtimeapi.org/api/timezone/{timezone}'
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url)
-                wtr = response.json().get('datetime')
+            response = await helper.http_clients.get().get(url)
+            wtr = response.json().get('datetime')
 
             wtr_obj = datetime.strptime(wtr, '%Y-%m-%dT%H:%M:%S.%f%z')
             time_24hr = wtr_obj.strftime('%H:%M:%S')
@@ -14,6 +14,9 @@ class YoutubeTranscriptPlugin(Plugin):
     def get_source_name(self) -> str:
         return 'YouTube Transcript'
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 86400
+
     def get_spec(self) -> [Dict]:
         return [
             {
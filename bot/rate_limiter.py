@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+
+class TokenBucket:
+    """
+    A bucket refilled continuously up to its capacity per minute. Its level may fall below zero when more
+    was used than reserved, delaying the next reservations until the debt is paid back.
+    """
+
+    def __init__(self, per_minute: int):
+        """
+        :param per_minute: The capacity of the bucket, refilled every minute, 0 for an unlimited bucket
+        """
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Gets the number of seconds until the bucket holds the given amount.
+        """
+        if not self.capacity:
+            return 0
+        self.refill()
+        return max(amount - self.level, 0) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        if self.capacity:
+            self.refill()
+            self.level -= amount
+
+    def give(self, amount: float) -> None:
+        if self.capacity:
+            self.refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Keeps requests within the requests and tokens per minute of the account, queueing them fairly,
+    in arrival order, until they fit instead of having them rejected by the API.
+    Tokens are reserved for the prompt and the longest possible completion, and the unused ones refunded
+    once the usage of the response is known.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        """
+        :param requests_per_minute: The number of requests per minute, 0 for no limit
+        :param tokens_per_minute: The number of tokens per minute, 0 for no limit
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = asyncio.Lock()  # wakes up its waiters in FIFO order
+        self.queue_depth = 0
+
+    async def acquire(self, tokens: int = 0) -> int:
+        """
+        Waits until a request of the given number of tokens fits into the limits, and reserves it.
+        :param tokens: The estimated number of tokens of the request, including the completion
+        :return: The number of tokens reserved, to be passed to `refund`
+        """
+        tokens = min(tokens, self.tokens.capacity)
+        self.queue_depth += 1
+        try:
+            async with self.lock:
+                while True:
+                    delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if delay <= 0:
+                        break
+                    logging.info(f'Waiting {delay:.1f}s for the rate limits, {self.queue_depth} requests queued')
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+        finally:
+            self.queue_depth -= 1
+        return tokens
+
+    def refund(self, reserved: int, used: int = 0) -> None:
+        """
+        Gives back the reserved tokens a request did not use, or takes the ones it used beyond its reservation.
+        :param reserved: The number of tokens reserved by `acquire`
+        :param used: The number of tokens used, 0 if the request failed
+        """
+        self.tokens.give(reserved - used)
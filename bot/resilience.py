@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import logging
+import math
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import httpx
+import openai
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the API while the circuit breaker is open.
+    """
+
+    def __init__(self, retry_in: float):
+        super().__init__(f'The API is unavailable, retrying in {math.ceil(retry_in)}s')
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Fails fast once the API has failed a number of consecutive times, instead of piling requests onto it.
+    After a cool-down, a single trial request is let through: its success closes the breaker again,
+    its failure opens it for another cool-down.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        """
+        :param failure_threshold: The number of consecutive failures opening the breaker, 0 to disable it
+        :param reset_seconds: The number of seconds the breaker stays open before a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self) -> None:
+        """
+        Checks whether a request may be sent.
+        :raises CircuitOpenError: If the breaker is open, or half-open with a trial request already running
+        """
+        state = self.state
+        if state == 'closed':
+            return
+        if state == 'half-open' and not self.trial_running:
+            self.trial_running = True
+            return
+        raise CircuitOpenError(max(self.opened_at + self.reset_seconds - time.monotonic(), 0))
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logging.info('Circuit breaker closed, the API is available again')
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.trial_running or (self.failure_threshold and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                logging.warning(f'Circuit breaker opened after {self.failures} consecutive failures')
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+    def record_ignored(self) -> None:
+        """
+        Records a request whose outcome says nothing about the health of the API, e.g. an invalid request.
+        """
+        self.trial_running = False
+
+
+class RetryPolicy:
+    """
+    Retries the transient failures of API calls with jittered exponential backoff, honouring the delays
+    the API asks for, behind a circuit breaker.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        :param max_attempts: The maximum number of attempts of a call
+        :param base_delay: The delay before the first retry, doubled for each further one
+        :param max_delay: The maximum delay before a retry. Calls are not retried if the API asks to wait longer
+        :param breaker: The circuit breaker, None to disable it
+        """
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker(0, 0)
+
+    async def call(self, fn: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        """
+        Calls the API, retrying transient failures.
+        :param fn: The API method
+        :return: The result of the API method
+        :raises CircuitOpenError: If the circuit breaker is open
+        """
+        for attempt in range(self.max_attempts):
+            self.breaker.before_call()
+            try:
+                result = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.record_ignored()
+                raise
+            except Exception as e:
+                if not self.is_transient(e):
+                    self.breaker.record_ignored()
+                    raise
+                self.breaker.record_failure()
+                delay = self.retry_delay(e, attempt)
+                if attempt + 1 >= self.max_attempts or delay is None or self.breaker.state == 'open':
+                    raise
+                logging.warning(f'API call failed ({e.__class__.__name__}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """
+        Checks whether a failed call may succeed if retried.
+        """
+        if isinstance(error, openai.RateLimitError):
+            return getattr(error, 'code', None) != 'insufficient_quota'
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in (408, 409) or error.status_code >= 500
+        return isinstance(error, (openai.APIConnectionError, httpx.TransportError))
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Gets the delay before retrying a failed call: the one asked for by the API, if any,
+        or a random delay of up to the exponential backoff otherwise ("full jitter").
+        :param error: The error of the failed call
+        :param attempt: The number of the failed attempt, starting at 0
+        :return: The delay in seconds, or None if the API asks to wait longer than the maximum delay
+        """
+        response = getattr(error, 'response', None)
+        requested = parse_retry_headers(response.headers) if response is not None else None
+        if requested is not None:
+            return requested if requested <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parses a duration as used by the `x-ratelimit-reset-*` headers, e.g. `1s`, `6m0s` or `20ms`.
+    :return: The duration in seconds, or None if it cannot be parsed
+    """
+    parts = DURATION_PART.findall(value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value.strip():
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_retry_headers(headers) -> Optional[float]:
+    """
+    Gets the delay the API asks to wait before retrying, from the `retry-after-ms` and `retry-after` headers,
+    or from the `x-ratelimit-reset-*` headers of the exhausted rate limits.
+    :param headers: The response headers
+    :return: The delay in seconds, or None if the API does not ask for one
+    """
+    try:
+        if 'retry-after-ms' in headers:
+            return max(float(headers['retry-after-ms']) / 1000, 0)
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            if value.strip().replace('.', '', 1).isdigit():
+                return float(value)
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(retry_at.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        pass
+
+    delays = []
+    for limit in ('requests', 'tokens'):
+        reset = headers.get(f'x-ratelimit-reset-{limit}')
+        if reset is not None and headers.get(f'x-ratelimit-remaining-{limit}', '0') == '0':
+            delays.append(parse_duration(reset))
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
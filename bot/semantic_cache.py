@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Embeds texts as vectors of a fixed dimension, e.g. with the OpenAI embeddings API
+Embedder = Callable[[list[str]], Awaitable[list[list[float]]]]
+
+
+class SemanticCache:
+    """
+    A cache of answers looked up by the meaning of their query rather than its exact text: the answer to
+    the most similar cached query is reused if the cosine similarity of their embeddings reaches a threshold.
+    The embeddings are kept in a NumPy matrix, searched in a single matrix product. Entries expire after
+    a time to live, and the least recently used one is evicted when the cache is full.
+    The cache can be persisted to an `.npy` file of embeddings along with a JSON file of answers.
+    """
+
+    def __init__(
+        self,
+        embed: Embedder,
+        max_size: int,
+        ttl_seconds: float,
+        threshold: float = 0.95,
+        path: Optional[str] = None,
+        namespace: str = '',
+    ):
+        """
+        :param embed: The function embedding the queries
+        :param max_size: The maximum number of entries
+        :param ttl_seconds: The number of seconds after which an entry expires
+        :param threshold: The minimum cosine similarity of a query to a cached one to reuse its answer
+        :param path: The path of the `.npy` file to persist the cache to, None to keep it in memory only
+        :param namespace: Identifies what the answers depend on, e.g. the model and system prompt.
+        A persisted cache is discarded if it was saved under another namespace
+        """
+        self.embed = embed
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.path = path
+        self.namespace = namespace
+        self.vectors = None  # (max_size, dimension) matrix of normalised embeddings, allocated on first use
+        self.answers: list[Optional[str]] = [None] * max_size
+        self.occupied = np.zeros(max_size, dtype=bool)
+        self.created = np.zeros(max_size)  # wall clock times, so that they can be persisted
+        self.last_used = np.zeros(max_size)
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return int(self.occupied.sum())
+
+    @staticmethod
+    def is_available() -> bool:
+        """
+        Whether the semantic cache can be used, i.e. NumPy is installed.
+        """
+        return np is not None
+
+    async def lookup(self, query: str) -> tuple[Optional[str], np.ndarray]:
+        """
+        Looks up the answer to the most similar cached query.
+        :param query: The query
+        :return: The answer, None if no cached query is similar enough, and the embedding of the query,
+        to pass to `add` along with its answer
+        """
+        embedding = self.__normalise(np.asarray((await self.embed([query]))[0], dtype=np.float32))
+        if self.vectors is None or self.vectors.shape[1] != embedding.shape[0]:
+            self.misses += 1
+            return None, embedding
+
+        similarities = self.vectors @ embedding
+        similarities[~self.occupied] = -np.inf
+        row = int(np.argmax(similarities))
+        if similarities[row] < self.threshold or self.created[row] + self.ttl_seconds <= time.time():
+            self.misses += 1
+            return None, embedding
+
+        self.last_used[row] = time.time()
+        self.hits += 1
+        return self.answers[row], embedding
+
+    def add(self, embedding: np.ndarray, answer: str) -> None:
+        """
+        Caches an answer, evicting the least recently used entry if the cache is full.
+        :param embedding: The embedding of the query, as returned by `lookup`
+        :param answer: The answer
+        """
+        now = time.time()
+        self.__put(embedding, answer, now, now)
+
+    def __put(self, embedding: np.ndarray, answer: str, created: float, last_used: float) -> None:
+        if self.vectors is None or self.vectors.shape[1] != embedding.shape[0]:
+            self.vectors = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+            self.occupied[:] = False
+        row = int(np.argmin(self.occupied)) if not self.occupied.all() else int(np.argmin(self.last_used))
+        self.vectors[row] = embedding
+        self.answers[row] = answer
+        self.occupied[row] = True
+        self.created[row] = created
+        self.last_used[row] = last_used
+
+    def expire(self):
+        """
+        Removes the expired entries.
+        :return: An iterator yielding True for each removed entry and False for each kept one
+        """
+        threshold = time.time() - self.ttl_seconds
+        for row in range(self.max_size):
+            if self.occupied[row] and self.created[row] <= threshold:
+                self.occupied[row] = False
+                self.answers[row] = None
+                yield True
+            else:
+                yield False
+
+    def save(self) -> None:
+        """
+        Persists the cache, if it has a path.
+        """
+        if self.path is None or self.vectors is None:
+            return
+        rows = np.flatnonzero(self.occupied)
+        np.save(self.path, self.vectors[rows])
+        with open(f'{self.path}.json', 'w') as file:
+            entries = [[self.answers[row], self.created[row], self.last_used[row]] for row in rows]
+            json.dump({'namespace': self.namespace, 'entries': entries}, file)
+
+    def load(self) -> None:
+        """
+        Loads the persisted cache, discarding it if it was saved under another namespace or cannot be read.
+        """
+        try:
+            vectors = np.load(self.path)
+            with open(f'{self.path}.json') as file:
+                metadata = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not load the semantic cache from {self.path}: {e}')
+            return
+        if metadata['namespace'] != self.namespace:
+            logging.info('Discarding the semantic cache, saved for another model or system prompt')
+            return
+
+        # Keep the most recently used entries if the cache was made smaller
+        entries = sorted(zip(vectors, metadata['entries']), key=lambda entry: entry[1][2])[-self.max_size :]
+        for vector, (answer, created, last_used) in entries:
+            self.__put(vector, answer, created, last_used)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of entries and the hit and miss counters.
+        """
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def __normalise(vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
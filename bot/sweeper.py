@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Callable, Iterator, Optional
+
+
+class ExpiringDict(MutableMapping):
+    """
+    A dict whose entries expire a given number of seconds after they were last set.
+    Expired entries are removed by `expire`, usually driven by an `ExpirySweeper`.
+    """
+
+    def __init__(self, max_age_seconds: float):
+        """
+        :param max_age_seconds: The number of seconds after which an entry expires, 0 for no expiry
+        """
+        self.max_age_seconds = max_age_seconds
+        self._data: OrderedDict = OrderedDict()  # {key: (timestamp, value)}, oldest first
+
+    def __getitem__(self, key):
+        return self._data[key][1]
+
+    def __setitem__(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def expire(self) -> Iterator[bool]:
+        """
+        Removes the expired entries, oldest first.
+        :return: An iterator yielding once per removed entry
+        """
+        if self.max_age_seconds <= 0:
+            return
+        threshold = time.monotonic() - self.max_age_seconds
+        while self._data:
+            key, (timestamp, _) = next(iter(self._data.items()))
+            if timestamp > threshold:
+                return
+            del self._data[key]
+            yield True
+
+
+class ExpirySweeper:
+    """
+    Periodically expires stale entries of the registered structures in a background task.
+    Each sweep runs in short time slices, yielding to the event loop in between.
+    The statistics of the registered structures, such as cache hits or evictions, are logged after each sweep.
+    """
+
+    def __init__(self, interval_seconds: float, slice_seconds: float = 0.005):
+        """
+        :param interval_seconds: The number of seconds between two sweeps
+        :param slice_seconds: The maximum number of seconds a sweep blocks the event loop at once
+        """
+        self.interval_seconds = interval_seconds
+        self.slice_seconds = slice_seconds
+        self.targets: dict[str, Callable[[], Iterator[bool]]] = {}
+        self.reporters: dict[str, Callable[[], dict]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, name: str, expire: Callable[[], Iterator[bool]]) -> None:
+        """
+        Registers a structure to sweep.
+        :param name: The name used when logging
+        :param expire: A function returning an iterator that expires entries,
+        yielding True for each freed entry and False for each kept one
+        """
+        self.targets[name] = expire
+
+    def add_stats(self, name: str, stats: Callable[[], dict]) -> None:
+        """
+        Registers the statistics of a structure, to log after each sweep.
+        :param name: The name used when logging
+        :param stats: A function returning the statistics
+        """
+        self.reporters[name] = stats
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Gets the statistics of all registered structures, by structure name.
+        """
+        return {name: stats() for name, stats in self.reporters.items()}
+
+    def start(self) -> None:
+        """
+        Starts the background task. Must be called from a running event loop.
+        """
+        if self.task is None and self.interval_seconds > 0:
+            self.task = asyncio.create_task(self.__run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background task.
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def sweep(self) -> dict[str, int]:
+        """
+        Runs a single sweep over all registered structures.
+        :return: The number of freed entries by structure name
+        """
+        freed = {}
+        deadline = time.monotonic() + self.slice_seconds
+        for name, expire in self.targets.items():
+            freed[name] = 0
+            for removed in expire():
+                freed[name] += removed
+                if time.monotonic() > deadline:
+                    await asyncio.sleep(0)
+                    deadline = time.monotonic() + self.slice_seconds
+        return freed
+
+    async def __run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                started = time.monotonic()
+                freed = await self.sweep()
+                if sum(freed.values()) > 0:
+                    details = ', '.join(f'{count} {name}' for name, count in freed.items())
+                    logging.info(f'Expiry sweep freed {details} in {time.monotonic() - started:.3f}s')
+                if self.reporters:
+                    logging.info('Stats: ' + '; '.join(f'{name} {stats}' for name, stats in self.stats().items()))
+            except Exception as e:
+                logging.exception(f'Expiry sweep failed: {e}')
@@ -9,9 +9,11 @@ from typing import Optional
 from uuid import uuid4
 
 import asyncpg
+from events import DirectResult, StreamEnd
 from openai_helper import OpenAIHelper, localized_text
 from PIL import Image
 from pydub import AudioSegment
+from sweeper import ExpiringDict, ExpirySweeper
 from telegram import (
     BotCommand,
     BotCommandScopeAllGroupChats,
@@ -37,6 +39,7 @@ from telegram.ext import (
 )
 from usage_tracker import UsageTracker
 from utils import (
+    StreamBuffer,
     add_chat_request_to_usage_tracker,
     edit_message_with_retry,
     error_handler,
@@ -47,7 +50,6 @@ from utils import (
     handle_direct_result,
     is_admin,
     is_allowed,
-    is_direct_result,
     is_group_chat,
     is_within_budget,
     message_text,
@@ -117,9 +119,30 @@ class ChatGPTTelegramBot:
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
         self.usage = {}
-        self.last_message = {}
-        self.inline_queries_cache = {}
-        self.replies_tracker = {}
+        max_age_seconds = self.config['max_conversation_age_minutes'] * 60
+        self.last_message = ExpiringDict(max_age_seconds)
+        self.inline_queries_cache = ExpiringDict(max_age_seconds)
+        self.replies_tracker = ExpiringDict(max_age_seconds)
+        self.sweeper = ExpirySweeper(interval_seconds=self.config['sweep_interval_seconds'])
+        self.sweeper.add('conversations', self.openai.conversations.expire)
+        self.sweeper.add('idle conversations', self.openai.conversations.demote)
+        self.sweeper.add('images', self.openai.blobs.expire)
+        self.sweeper.add('plugin results', self.openai.plugin_manager.cache.expire)
+        self.sweeper.add('inline answers', self.openai.inline_cache.expire)
+        if self.openai.semantic_cache is not None:
+            self.sweeper.add('semantic answers', self.openai.semantic_cache.expire)
+        self.sweeper.add('client affinity', self.openai.clients.affinity.expire)
+        self.sweeper.add('replies', self.replies_tracker.expire)
+        self.sweeper.add('last messages', self.last_message.expire)
+        self.sweeper.add('inline queries', self.inline_queries_cache.expire)
+        self.sweeper.add_stats('conversations', self.openai.conversations.stats)
+        self.sweeper.add_stats('plugin results', self.openai.plugin_manager.cache.stats)
+        self.sweeper.add_stats('inline answers', self.openai.inline_cache.stats)
+        if self.openai.semantic_cache is not None:
+            self.sweeper.add_stats('semantic answers', self.openai.semantic_cache.stats)
+        self.sweeper.add_stats('OpenAI clients', lambda: {'queue depth': self.openai.clients.queue_depth})
+        if self.openai.router.rules:
+            self.sweeper.add_stats('model routing', self.openai.router.stats)
 
     def get_thread_id(self, update: Update) -> str:
         c = update.effective_chat.id
@@ -558,6 +581,10 @@ class ChatGPTTelegramBot:
                     if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
                         self.usage['guests'].add_chat_tokens(total_tokens, self.config['token_price'])
 
+                    if isinstance(response, DirectResult):
+                        await handle_direct_result(self.config, update, response, self.save_reply)
+                        return
+
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = (
                         f"_{localized_text('transcript', bot_language)}:_\n\"{transcript}\"\n\n"
@@ -686,46 +713,51 @@ class ChatGPTTelegramBot:
 
             if self.config['stream']:
                 stream_response = self.openai.interpret_image_stream(
-                    chat_id=ai_context_id, fileobj=temp_file_png, prompt=prompt
+                    chat_id=ai_context_id, fileobj=temp_file_png, prompt=prompt, image_id=image.file_unique_id
                 )
                 i = 0
-                prev = ''
+                prev_length = 0
                 sent_message = None
                 backoff = 0
-                stream_chunk = 0
+                buffer = StreamBuffer()
+
+                async for event in stream_response:
+                    if isinstance(event, DirectResult):
+                        total_tokens = event.tokens
+                        await handle_direct_result(self.config, update, event, self.save_reply)
+                        break
 
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content, self.save_reply)
+                    finished = isinstance(event, StreamEnd)
+                    if finished:
+                        total_tokens = event.tokens
+                    completed = buffer.append(event.footer if finished else event.text)
 
-                    if len(content.strip()) == 0:
+                    if buffer.blank:
                         continue
 
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(
-                                    context,
-                                    chat_id,
-                                    str(sent_message.message_id),
-                                    stream_chunks[-2],
-                                )
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_forum_thread_id(update),
-                                    text=content if len(content) > 0 else '...',
-                                )
-                                self.save_reply(sent_message, update)
-                            except:
-                                pass
+                    content = buffer.text()
+                    if completed:
+                        try:
+                            await edit_message_with_retry(
+                                context,
+                                chat_id,
+                                str(sent_message.message_id),
+                                buffer.chunks[-1],
+                            )
+                        except:
+                            pass
+                        try:
+                            sent_message = await update.effective_message.reply_text(
+                                message_thread_id=get_forum_thread_id(update),
+                                text=content if len(content) > 0 else '...',
+                            )
+                            self.save_reply(sent_message, update)
+                        except:
+                            pass
+                        if not finished:
                             continue
 
-                    cutoff = get_stream_cutoff_values(update, content)
+                    cutoff = get_stream_cutoff_values(update, buffer.length)
                     cutoff += backoff
 
                     if i == 0:
@@ -744,11 +776,11 @@ class ChatGPTTelegramBot:
                         except:
                             continue
 
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
+                    elif abs(buffer.length - prev_length) > cutoff or finished:
+                        prev_length = buffer.length
 
                         try:
-                            use_markdown = tokens != 'not_finished'
+                            use_markdown = finished
                             await edit_message_with_retry(
                                 context,
                                 chat_id,
@@ -774,13 +806,11 @@ class ChatGPTTelegramBot:
                         await asyncio.sleep(0.01)
 
                     i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
 
             else:
                 try:
                     interpretation, total_tokens = await self.openai.interpret_image(
-                        ai_context_id, temp_file_png, prompt=prompt
+                        ai_context_id, temp_file_png, prompt=prompt, image_id=image.file_unique_id
                     )
 
                     try:
@@ -878,43 +908,48 @@ class ChatGPTTelegramBot:
 
                 stream_response = self.openai.get_chat_response_stream(chat_id=ai_context_id, query=prompt)
                 i = 0
-                prev = ''
+                prev_length = 0
                 sent_message = None
                 backoff = 0
-                stream_chunk = 0
+                buffer = StreamBuffer()
 
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content, self.save_reply)
+                async for event in stream_response:
+                    if isinstance(event, DirectResult):
+                        total_tokens = event.tokens
+                        await handle_direct_result(self.config, update, event, self.save_reply)
+                        break
 
-                    if len(content.strip()) == 0:
+                    finished = isinstance(event, StreamEnd)
+                    if finished:
+                        total_tokens = event.tokens
+                    completed = buffer.append(event.footer if finished else event.text)
+
+                    if buffer.blank:
                         continue
 
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(
-                                    context,
-                                    chat_id,
-                                    str(sent_message.message_id),
-                                    stream_chunks[-2],
-                                )
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_forum_thread_id(update),
-                                    text=content if len(content) > 0 else '...',
-                                )
-                                self.save_reply(sent_message, update)
-                            except:
-                                pass
+                    content = buffer.text()
+                    if completed:
+                        try:
+                            await edit_message_with_retry(
+                                context,
+                                chat_id,
+                                str(sent_message.message_id),
+                                buffer.chunks[-1],
+                            )
+                        except:
+                            pass
+                        try:
+                            sent_message = await update.effective_message.reply_text(
+                                message_thread_id=get_forum_thread_id(update),
+                                text=content if len(content) > 0 else '...',
+                            )
+                            self.save_reply(sent_message, update)
+                        except:
+                            pass
+                        if not finished:
                             continue
 
-                    cutoff = get_stream_cutoff_values(update, content)
+                    cutoff = get_stream_cutoff_values(update, buffer.length)
                     cutoff += backoff
 
                     if i == 0:
@@ -933,11 +968,11 @@ class ChatGPTTelegramBot:
                         except:
                             continue
 
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
+                    elif abs(buffer.length - prev_length) > cutoff or finished:
+                        prev_length = buffer.length
 
                         try:
-                            use_markdown = tokens != 'not_finished'
+                            use_markdown = finished
                             await edit_message_with_retry(
                                 context,
                                 chat_id,
@@ -963,8 +998,6 @@ class ChatGPTTelegramBot:
                         await asyncio.sleep(0.01)
 
                     i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
 
             else:
 
@@ -972,7 +1005,7 @@ class ChatGPTTelegramBot:
                     nonlocal total_tokens
                     response, total_tokens = await self.openai.get_chat_response(chat_id=ai_context_id, query=prompt)
 
-                    if is_direct_result(response):
+                    if isinstance(response, DirectResult):
                         return await handle_direct_result(self.config, update, response, self.save_reply)
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
@@ -1102,13 +1135,27 @@ class ChatGPTTelegramBot:
                     return
 
                 unavailable_message = localized_text('function_unavailable_in_inline_mode', bot_language)
-                if self.config['stream']:
+                if self.openai.is_inline_cacheable():
+                    response, total_tokens = await self.openai.get_inline_response(chat_id=str(user_id), query=query)
+
+                    # We only want to send the first 4096 characters. No chunking allowed in inline mode.
+                    await edit_message_with_retry(
+                        context,
+                        chat_id=None,
+                        message_id=inline_message_id,
+                        text=f'{query}\n\n_{answer_tr}:_\n{response}'[:4096],
+                        is_inline=True,
+                    )
+
+                elif self.config['stream']:
                     stream_response = self.openai.get_chat_response_stream(chat_id=str(user_id), query=query)
                     i = 0
-                    prev = ''
+                    prev_length = 0
                     backoff = 0
-                    async for content, tokens in stream_response:
-                        if is_direct_result(content):
+                    buffer = StreamBuffer()
+                    async for event in stream_response:
+                        if isinstance(event, DirectResult):
+                            total_tokens = event.tokens
                             await edit_message_with_retry(
                                 context,
                                 chat_id=None,
@@ -1116,12 +1163,20 @@ class ChatGPTTelegramBot:
                                 text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
                                 is_inline=True,
                             )
-                            return
+                            break
+
+                        finished = isinstance(event, StreamEnd)
+                        if finished:
+                            total_tokens = event.tokens
+                        buffer.append(event.footer if finished else event.text)
 
-                        if len(content.strip()) == 0:
+                        if buffer.blank:
                             continue
 
-                        cutoff = get_stream_cutoff_values(update, content)
+                        # No chunking allowed in inline mode, only the first chunk is shown
+                        content = buffer.chunks[0] if buffer.chunks else buffer.text()
+                        length = len(content)
+                        cutoff = get_stream_cutoff_values(update, length)
                         cutoff += backoff
 
                         if i == 0:
@@ -1136,10 +1191,10 @@ class ChatGPTTelegramBot:
                             except:
                                 continue
 
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
+                        elif abs(length - prev_length) > cutoff or finished:
+                            prev_length = length
                             try:
-                                use_markdown = tokens != 'not_finished'
+                                use_markdown = finished
                                 divider = '_' if use_markdown else ''
                                 text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
 
@@ -1170,8 +1225,6 @@ class ChatGPTTelegramBot:
                             await asyncio.sleep(0.01)
 
                         i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
 
                 else:
 
@@ -1187,7 +1240,7 @@ class ChatGPTTelegramBot:
                         logging.info(f'Generating response for inline query by {name}')
                         response, total_tokens = await self.openai.get_chat_response(chat_id=str(user_id), query=query)
 
-                        if is_direct_result(response):
+                        if isinstance(response, DirectResult):
                             await edit_message_with_retry(
                                 context,
                                 chat_id=None,
@@ -1289,6 +1342,7 @@ class ChatGPTTelegramBot:
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        await self.openai.prewarm()
 
         if self.config['database_url']:
             self.openai.db_pool = await asyncpg.create_pool(dsn=self.config['database_url'])
@@ -1296,9 +1350,16 @@ class ChatGPTTelegramBot:
                 await connection.execute('drop schema public cascade')
                 await connection.execute('create schema public')
 
+        self.sweeper.start()
+
     async def post_shutdown(self, _: Application) -> None:
+        await self.sweeper.stop()
+        self.openai.conversations.close()
         if self.openai.db_pool:
             await self.openai.db_pool.close()
+        await self.openai.http_clients.aclose()
+        if self.openai.semantic_cache is not None:
+            self.openai.semantic_cache.save()
 
     def run(self):
         """
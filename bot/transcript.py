@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import tiktoken
+from conversation_store import Message
+
+
+def truncate_text(text: str, max_chars: int) -> str:
+    """
+    Truncates a text to the given number of characters, marking the cut.
+    """
+    if len(text) <= max_chars:
+        return text
+    return f'{text[:max_chars]}… [{len(text) - max_chars} more characters]'
+
+
+def render_message(message: Message, max_function_result_chars: int = 500) -> str:
+    """
+    Renders a history entry as a single role-prefixed line of text.
+    Images are replaced by a placeholder, the answer following them describes them anyway.
+    :param message: The message
+    :param max_function_result_chars: The number of characters function results are truncated to
+    :return: The rendered message
+    """
+    content = ' '.join(message.content.split())
+    if message.role in ('function', 'tool'):
+        return f'{message.role} {message.name}: {truncate_text(content, max_function_result_chars)}'
+    if message.tool_calls:
+        calls = ', '.join(call['function']['name'] for call in message.tool_calls)
+        content = f'[called {calls}] {content}'
+    if message.image is not None:
+        content = f'[image] {content}'
+    return f'{message.role}: {content}'
+
+
+def render_transcript(
+    messages: list[Message],
+    encoding: tiktoken.Encoding,
+    max_tokens: int,
+    max_function_result_chars: int = 500,
+) -> str:
+    """
+    Renders a conversation history as compact text, e.g. to summarise it.
+    The most recent messages are kept when the history does not fit into the token budget.
+    :param messages: The messages to render
+    :param encoding: The encoding used to count tokens
+    :param max_tokens: The token budget of the transcript
+    :param max_function_result_chars: The number of characters function results are truncated to
+    :return: The transcript
+    """
+    lines = []
+    tokens = 0
+    for message in reversed(messages):
+        line = render_message(message, max_function_result_chars)
+        line_tokens = len(encoding.encode(line)) + 1  # newline
+        if tokens + line_tokens > max_tokens:
+            if not lines:
+                # Keep the end of a single message too long for the budget
+                lines.append(encoding.decode(encoding.encode(line)[-max_tokens:]))
+            lines.append('[earlier messages omitted]')
+            break
+        lines.append(line)
+        tokens += line_tokens
+    return '\n'.join(reversed(lines))
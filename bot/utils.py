@@ -1,13 +1,12 @@
 from __future__ import annotations
 
 import asyncio
-import base64
 import itertools
-import json
 import logging
 from typing import Callable, Optional
 
 import telegram
+from events import DirectResult
 from telegram import ChatMember, Message, MessageEntity, Update, constants
 from telegram.ext import CallbackContext, ContextTypes
 from usage_tracker import UsageTracker
@@ -59,14 +58,14 @@ def get_forum_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
+def get_stream_cutoff_values(update: Update, length: int) -> int:
     """
     Gets the stream cutoff values for the message length
     """
     if is_group_chat(update):
         # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 else 25 if len(content) > 50 else 15
+        return 180 if length > 1000 else 120 if length > 200 else 90 if length > 50 else 50
+    return 90 if length > 1000 else 45 if length > 200 else 25 if length > 50 else 15
 
 
 def is_group_chat(update: Update) -> bool:
@@ -88,6 +87,50 @@ def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     return [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
 
 
+class StreamBuffer:
+    """
+    Accumulates a streamed answer split into chunks of a given size, like `split_into_chunks`, in linear time.
+    Leading whitespace is dropped. Only the current chunk is joined, when it is displayed.
+    """
+
+    def __init__(self, chunk_size: int = 4096):
+        self.chunk_size = chunk_size
+        self.chunks: list[str] = []  # completed chunks
+        self.parts: list[str] = []  # pieces of the current chunk
+        self.length = 0  # length of the current chunk
+        self.blank = True
+
+    def append(self, text: str) -> int:
+        """
+        Appends a piece of text.
+        :param text: The text
+        :return: The number of chunks completed by it
+        """
+        if self.blank:
+            text = text.lstrip()
+            if not text:
+                return 0
+            self.blank = False
+        completed = 0
+        while self.length + len(text) > self.chunk_size:
+            cut = self.chunk_size - self.length
+            self.parts.append(text[:cut])
+            self.chunks.append(''.join(self.parts))
+            self.parts, self.length = [], 0
+            text = text[cut:]
+            completed += 1
+        if text:
+            self.parts.append(text)
+            self.length += len(text)
+        return completed
+
+    def text(self) -> str:
+        """
+        Gets the text of the current chunk.
+        """
+        return ''.join(self.parts)
+
+
 async def wrap_with_indicator(
     update: Update,
     context: CallbackContext,
@@ -329,32 +372,12 @@ def get_reply_to_message_id(config, update: Update):
     return None
 
 
-def is_direct_result(response: any) -> bool:
-    """
-    Checks if the dict contains a direct result that can be sent directly to the user
-    :param response: The response value
-    :return: Boolean indicating if the result is a direct result
-    """
-    if not isinstance(response, dict):
-        try:
-            json_response = json.loads(response)
-            return json_response.get('direct_result', False)
-        except:
-            return False
-    else:
-        return response.get('direct_result', False)
-
-
-async def handle_direct_result(config, update: Update, response: any, save_reply: Optional[Callable] = None):
+async def handle_direct_result(config, update: Update, result: DirectResult, save_reply: Optional[Callable] = None):
     """
     Handles a direct result from a plugin
     """
-    if not isinstance(response, dict):
-        response = json.loads(response)
-
-    result = response['direct_result']
-    kind = result['kind']
-    value = result['value']
+    kind = result.kind
+    value = result.value
 
     common_args = {
         'message_thread_id': get_forum_thread_id(update),
@@ -379,14 +402,3 @@ async def handle_direct_result(config, update: Update, response: any, save_reply
 
     if save_reply and sent_msg:
         save_reply(sent_msg, update)
-
-
-# Function to encode the image
-def encode_image(fileobj):
-    image = base64.b64encode(fileobj.getvalue()).decode('utf-8')
-    return f'data:image/jpeg;base64,{image}'
-
-
-def decode_image(imgbase64):
-    image = imgbase64[len('data:image/jpeg;base64,') :]
-    return base64.b64decode(image)
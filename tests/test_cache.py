@@ -0,0 +1,49 @@
+import asyncio
+
+from cache import SingleFlight
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(flight.do('key', fn) for _ in range(3)))
+        assert results == [1, 1, 1]
+        assert flight.coalesced == 2
+        assert len(flight) == 0
+
+    asyncio.run(main())
+
+
+def test_single_flight_call_after_last_waiter_cancelled_starts_a_new_one():
+    async def main():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.01)  # cleans up before finishing cancelled
+                raise
+
+        async def fast():
+            return 'result'
+
+        waiter = asyncio.ensure_future(flight.do('key', slow))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        # The cancelled call may not be done yet, a new caller must not join it
+        assert await flight.do('key', fast) == 'result'
+
+    asyncio.run(main())
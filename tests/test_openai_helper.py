@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+
+import model_registry
+import pytest
+from events import StreamEnd, TextDelta
+from openai_helper import OpenAIHelper
+from plugin_manager import PluginManager
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def fake_encoding(monkeypatch):
+    monkeypatch.setattr(model_registry.tiktoken, 'get_encoding', lambda name: FakeEncoding())
+    yield
+    for profile in {*model_registry.MODEL_PROFILES.values(), *model_registry._resolved.values()}:
+        object.__setattr__(profile, 'encoding', None)
+
+
+def chunk(content=None, usage=None):
+    choices = (
+        [] if usage else [SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=None), finish_reason=None)]
+    )
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def test_streamed_answer_is_not_cut_off(fake_encoding, tmp_path):
+    config = {
+        'api_key': 'key',
+        'model': 'gpt-4o',
+        'vision_model': 'gpt-4o',
+        'assistant_prompt': 'You are a helpful assistant.',
+        'allowed_chat_ids_to_track': set(),
+        'max_history_size': 15,
+        'max_conversation_age_minutes': 180,
+        'max_tokens': 100,
+        'image_store_path': str(tmp_path),
+        'bot_language': 'en',
+        'temperature': 1,
+        'n_choices': 1,
+        'presence_penalty': 0,
+        'frequency_penalty': 0,
+        'enable_functions': True,
+        'functions_max_consecutive_calls': 10,
+        'show_usage': False,
+        'show_plugins_used': False,
+        'api_max_attempts': 1,
+    }
+    helper = OpenAIHelper(config, PluginManager({'plugins': []}))
+    closed = []
+
+    async def create(**kwargs):
+        async def stream():
+            try:
+                for content in ('', 'A', 'B', 'C', 'D'):
+                    yield chunk(content)
+                    await asyncio.sleep(0)
+                yield chunk(usage=SimpleNamespace(prompt_tokens=10, completion_tokens=4, total_tokens=14))
+            finally:
+                closed.append(True)
+
+        return stream()
+
+    helper.clients.members[0].client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    async def main():
+        events = []
+        async for event in helper.get_chat_response_stream('1', 'Hello'):
+            events.append(event)
+            await asyncio.sleep(0.01)  # e.g. editing the Telegram message
+        return events
+
+    events = asyncio.run(main())
+    assert events == [TextDelta('A'), TextDelta('B'), TextDelta('C'), TextDelta('D'), StreamEnd('', 14)]
+    assert helper.conversations.get('1').messages[-1].content == 'ABCD'
+    assert closed == [True]
+    assert helper.clients.members[0].in_flight == 0
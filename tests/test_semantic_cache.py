@@ -0,0 +1,92 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import semantic_cache  # noqa: E402
+from semantic_cache import SemanticCache  # noqa: E402
+
+# Queries meaning the same thing are embedded close to each other
+VECTORS = {
+    'weather in paris': [1.0, 0.0, 0.0],
+    'paris weather': [0.99, 0.1, 0.0],
+    'capital of france': [0.7, 0.7, 0.0],
+    'tell me a joke': [0.0, 0.0, 1.0],
+    'say something funny': [0.0, 0.1, 0.99],
+}
+
+
+async def embed(texts):
+    return [VECTORS[text] for text in texts]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(semantic_cache, 'time', SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def cached(cache, query, answer):
+    _, embedding = asyncio.run(cache.lookup(query))
+    cache.add(embedding, answer)
+
+
+def test_similar_query_hits_and_dissimilar_one_misses(clock):
+    cache = SemanticCache(embed, max_size=4, ttl_seconds=60, threshold=0.95)
+    cached(cache, 'weather in paris', 'Sunny')
+
+    assert asyncio.run(cache.lookup('paris weather'))[0] == 'Sunny'
+    assert asyncio.run(cache.lookup('capital of france'))[0] is None
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 2}
+
+
+def test_entries_expire_after_their_time_to_live(clock):
+    cache = SemanticCache(embed, max_size=4, ttl_seconds=60)
+    cached(cache, 'weather in paris', 'Sunny')
+
+    clock.value += 61
+    assert asyncio.run(cache.lookup('weather in paris'))[0] is None
+    assert list(cache.expire()) == [True, False, False, False]
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_replaced_when_full(clock):
+    cache = SemanticCache(embed, max_size=2, ttl_seconds=60)
+    cached(cache, 'weather in paris', 'Sunny')
+    clock.value += 1
+    cached(cache, 'tell me a joke', 'Knock knock')
+    clock.value += 1
+    assert asyncio.run(cache.lookup('weather in paris'))[0] == 'Sunny'
+
+    clock.value += 1
+    cached(cache, 'capital of france', 'Paris')
+    assert len(cache) == 2
+    assert asyncio.run(cache.lookup('say something funny'))[0] is None
+    assert asyncio.run(cache.lookup('paris weather'))[0] == 'Sunny'
+
+
+def test_save_and_load_round_trip(clock, tmp_path):
+    path = str(tmp_path / 'semantic_cache.npy')
+    cache = SemanticCache(embed, max_size=4, ttl_seconds=60, path=path, namespace='gpt-4o')
+    cached(cache, 'weather in paris', 'Sunny')
+    cached(cache, 'tell me a joke', 'Knock knock')
+    cache.save()
+
+    loaded = SemanticCache(embed, max_size=4, ttl_seconds=60, path=path, namespace='gpt-4o')
+    assert len(loaded) == 2
+    assert asyncio.run(loaded.lookup('paris weather'))[0] == 'Sunny'
+    assert asyncio.run(loaded.lookup('say something funny'))[0] == 'Knock knock'
+
+
+def test_cache_saved_under_another_namespace_is_discarded(clock, tmp_path):
+    path = str(tmp_path / 'semantic_cache.npy')
+    cache = SemanticCache(embed, max_size=4, ttl_seconds=60, path=path, namespace='gpt-4o')
+    cached(cache, 'weather in paris', 'Sunny')
+    cache.save()
+
+    loaded = SemanticCache(embed, max_size=4, ttl_seconds=60, path=path, namespace='gpt-4o-mini')
+    assert len(loaded) == 0
+    assert asyncio.run(loaded.lookup('weather in paris'))[0] is None